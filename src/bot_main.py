@@ -11,8 +11,11 @@ from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_applicati
 from sqlalchemy import URL
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine
 from middleware.outer import DatabaseMiddleware, StoreAllUpdates, CheckUserType
+from middleware.outer import FSMSnapshotMiddleware, ReleaseDatabaseMiddleware
 from middleware.inner import StoreAllMessages
-from storage import db_schema
+from modules import queue_publisher
+from storage import db_migrate
+from storage.audit_log import AuditLog
 from utils.config import config
 from utils.log import setup_logger
 from handlers import (
@@ -97,15 +100,31 @@ async def async_main() -> None:
         host=config["DB"]["HOST"],
         database=config["DB"]["NAME"],
     )
-    async_engine: AsyncEngine = create_async_engine(db_url, echo=False)
+    pool_config = config["DB"].get("POOL", {})
+    async_engine: AsyncEngine = create_async_engine(
+        db_url,
+        echo=False,
+        pool_size=pool_config.get("SIZE", 5),
+        max_overflow=pool_config.get("MAX_OVERFLOW", 10),
+        pool_timeout=pool_config.get("TIMEOUT", 30),
+        pool_recycle=pool_config.get("RECYCLE", 1800),
+        pool_pre_ping=pool_config.get("PRE_PING", False),
+    )
 
-    # Create DB structures
+    # Create DB structures and apply migrations
     async with async_engine.begin() as conn:
-        # DROP TABLES: await conn.run_sync(db_schema.Base.metadata.drop_all)
-        await conn.run_sync(db_schema.Base.metadata.create_all)
+        # DROP TABLES: await conn.run_sync(db_migrate.Base.metadata.drop_all)
+        await db_migrate.migrate(
+            conn, config["DB"].get("PARTITIONS", {}).get("MONTHS_AHEAD", 1)
+        )
 
     # Create internal objects
-    redis = Redis(host="localhost")
+    redis_config = config.get("REDIS", {})
+    redis = Redis(
+        host=redis_config.get("HOST", "localhost"),
+        port=redis_config.get("PORT", 6379),
+        db=redis_config.get("DB", 0),
+    )
     storage = RedisStorage(redis=redis)
     async_session = async_sessionmaker(async_engine, expire_on_commit=False)
     bot = Bot(
@@ -127,11 +146,27 @@ async def async_main() -> None:
     dp.include_router(fsm_abonement.router)  # Abonement: messages
     dp.include_router(other_handlers.router)  # Other messages
 
+    # Log of all updates and messages (written by batches)
+    audit_config = config["DB"].get("AUDIT_LOG", {})
+    audit_log = AuditLog(
+        async_session,
+        batch_size=audit_config.get("BATCH_SIZE", 100),
+        flush_interval=audit_config.get("FLUSH_INTERVAL", 1.0),
+        queue_size=audit_config.get("QUEUE_SIZE", 10000),
+    )
+    dp.startup.register(audit_log.start)
+
+    # Close RabbitMQ publisher and flush log on shutdown
+    dp.shutdown.register(queue_publisher.close)
+    dp.shutdown.register(audit_log.close)
+
     # Add middleware
     dp.update.outer_middleware(DatabaseMiddleware(session=async_session))
-    dp.update.outer_middleware(StoreAllUpdates())
+    dp.update.outer_middleware(FSMSnapshotMiddleware())
+    dp.update.outer_middleware(StoreAllUpdates(audit_log))
     dp.message.outer_middleware(CheckUserType())
-    dp.message.middleware(StoreAllMessages())
+    dp.message.middleware(StoreAllMessages(audit_log))
+    bot.session.middleware(ReleaseDatabaseMiddleware())
 
     # Select bot mode
     if config["BOT"]["MODE"] == "webhook":
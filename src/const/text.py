@@ -168,9 +168,11 @@ msg: dict[str, str] = {
     "diag_bot": "Бот",
     "diag_bot_info": "Информация о пользователе в aiogram",
     "diag_db_info": "Информация о пользователе в БД",
+    "diag_user_cache": "Кеш пользователей",
     "diag_rabbitmq_info": "Информация об очередях",
     "diag_any_msg": "Расшифровка",
     "diag_cancel": "Завершение диагностики. Вы в главном меню",
+    "diag_recount": "Счетчики посещений пересчитаны, абонементов: ",
     # Registration mode messages
     "reg_main": "Регистрация нового пользователя",
     "reg_no_agree": "Нужно согласиться или отправить /cancel",
@@ -230,6 +232,7 @@ help: dict[str, str] = {
     "owner_link": "https://github.com/yurboc/virtual-camp",
     "diag_cmd": "Режим диагностики",
     "diag_info": "/info - информация о пользователе",
+    "diag_recount": "/recount - пересчет счетчиков посещений абонементов",
     "reg_cmd": "Режим регистрации",
     "reg_cancel": "/cancel - отменить регистрацию",
     "invites_cmd": "Режим работы с приглашениями",
@@ -352,7 +352,8 @@ async def process_good_description_abonement_command(
             logger.warning("FSM: abonement: can't create new abonement")
     # Create/update spreadsheet for Abonement
     if abonement_id:
-        queue_publisher.result(
+        await db.commit()  # notifier reads Abonement from DB
+        await queue_publisher.result(
             {
                 "job_type": "abonement_update",
                 "abonement_id": abonement_id,
@@ -581,7 +582,8 @@ async def process_visit_edit_command(
     # Set Visit date
     result = await db.abonement_visit_update(visit_id, user_id, visit_date)
     if result:
-        queue_publisher.result(
+        await db.commit()  # notifier reads Visit from DB
+        await queue_publisher.result(
             {
                 "job_type": "abonement_visit",
                 "msg_type": "visit_edit",
@@ -617,7 +619,8 @@ async def process_visit_delete_command(
         result = await db.abonement_visit_delete(visit_id=visit_id, user_id=user_id)
         logger.info("FSM: abonement: visit %s deleted: %s", visit_id, result)
         if result:
-            queue_publisher.result(
+            await db.commit()  # notifier reads Abonement from DB
+            await queue_publisher.result(
                 {
                     "job_type": "abonement_visit",
                     "msg_type": "visit_delete",
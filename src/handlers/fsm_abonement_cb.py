@@ -10,7 +10,7 @@ from aiogram.fsm.state import default_state
 from aiogram.utils.formatting import Text, Bold, Italic, TextLink, as_list, as_key_value
 from aiogram.utils.deep_linking import create_start_link
 from const.states import MainGroup, AbonementGroup
-from keyboards.inline import AbonementCallbackFactory
+from keyboards.inline import AbonementCallbackFactory, AbonementPageCallbackFactory
 from storage.db_api import Database
 from modules import queue_publisher
 from utils.config import config
@@ -39,9 +39,6 @@ async def callbacks_abonement_open(
 ):
     logger.info("Abonement entering: %s", callback_data.id)
     await callback.answer()
-    await state.update_data(
-        {"offset": 0, "limit": config["BOT"]["ABONEMENTS"]["PAGINATION_LIMIT"]}
-    )
     await state.set_state(AbonementGroup.open)
     abonement = await db.abonement_by_id(callback_data.id)
     user = await db.user_by_tg_id(callback.from_user.id)
@@ -52,7 +49,7 @@ async def callbacks_abonement_open(
     notify = await db.settings_value(user.id, "notify_abonement_%s" % abonement.id)
     if callback.message and isinstance(callback.message, Message):
         await callback.message.edit_reply_markup(None)
-        visits_count = await db.abonement_visits_count(abonement.id)
+        visits_count = abonement.visits_count
         my_visits_count = await db.abonement_visits_count(abonement.id, user_id=user.id)
         await callback.message.answer(
             **ab_info(
@@ -153,11 +150,15 @@ async def callbacks_abonement_accept_visit(
         if callback.message and isinstance(callback.message, Message):
             await callback.message.answer(msg["ab_failure_callback"])
         return
-    abonement_visit = await db.abonement_visit_add(abonement.id, user.id)
+    visit_result = await db.abonement_visit_add(abonement.id, user.id)
+    await db.commit()  # release Abonement row lock, notifier reads Visit from DB
     if callback.message and isinstance(callback.message, Message):
-        if abonement_visit:  # Visit DONE
+        if visit_result:  # Visit DONE
+            abonement_visit, visits_left = visit_result
             result = [msg["ab_visit"], Bold(abonement_visit.ts.strftime(date_h_m_fmt))]
-            queue_publisher.result(
+            if visits_left is not None:
+                result.append(as_key_value(msg["ab_left_visits"], visits_left))
+            await queue_publisher.result(
                 {
                     "job_type": "abonement_visit",
                     "msg_type": "visit_new",
@@ -179,47 +180,43 @@ async def callbacks_abonement_accept_visit(
 # History of Abonement
 @router.callback_query(
     StateFilter(AbonementGroup.open),
-    AbonementCallbackFactory.filter(F.action.in_(["history", "prev", "next"])),
+    AbonementPageCallbackFactory.filter(F.action.in_(["history", "prev", "next"])),
 )
 async def callbacks_abonement_visits(
     callback: CallbackQuery,
-    callback_data: AbonementCallbackFactory,
+    callback_data: AbonementPageCallbackFactory,
     state: FSMContext,
     db: Database,
 ):
-    logger.info("Abonement history: %s", callback_data.id)
+    logger.info("Abonement history: %s", callback_data.token)
     await callback.answer()
-    abonement = await db.abonement_by_id(callback_data.id)
-    if not abonement or abonement.token != callback_data.token:
+    abonement = await db.abonement_by_token(callback_data.token)
+    if not abonement:
         if callback.message and isinstance(callback.message, Message):
             await callback.message.answer(msg["ab_failure_callback"])
         return
     if callback.message and isinstance(callback.message, Message):
-        # Calculate pagination
-        total = await db.abonement_visits_count(abonement.id)
-        limit = await state.get_value(
-            "limit", config["BOT"]["ABONEMENTS"]["PAGINATION_LIMIT"]
-        )
-        offset = await state.get_value("offset", 0)
-        action = callback_data.action
-        logger.info("Abonement history %s: %s, %s, %s", action, total, limit, offset)
-        if action == "prev":
-            if offset == 0:
-                return
-            if offset > limit:
-                offset -= limit
-            else:
-                offset = 0
-        elif action == "next":
-            if offset + limit >= total:
-                return
-            offset += limit
-        await state.update_data({"offset": offset, "limit": limit})
-        await callback.message.edit_reply_markup(None)
         # Get visits for current page
-        visits_list = await db.abonement_visits_list(
-            abonement.id, limit=limit, offset=offset
+        total = abonement.visits_count
+        limit = config["BOT"]["ABONEMENTS"]["PAGINATION_LIMIT"]
+        action = callback_data.action
+        cursor = callback_data.cursor if action in ["prev", "next"] else ""
+        logger.info("Abonement history %s: %s, %s, %s", action, total, limit, cursor)
+        visits_list, has_more = await db.abonement_visits_page(
+            abonement.id,
+            limit,
+            ikb.parse_visit_cursor(cursor),
+            "prev" if action == "prev" else "next",
         )
+        if action in ["prev", "next"] and not visits_list:
+            return
+        has_prev = has_more if action == "prev" else action == "next"
+        has_next = has_more if action != "prev" else True
+        # Save current page for Visit EDIT or DELETE
+        await state.update_data(
+            {"cursor": ikb.visit_cursor(visits_list[0]) if visits_list else ""}
+        )
+        await callback.message.edit_reply_markup(None)
         visits_text = []
         # Generate one line for each visit
         for visit in visits_list:
@@ -235,13 +232,20 @@ async def callbacks_abonement_visits(
                     ),
                 ),
             ]
-        answer = as_list(ab_page(offset, total, len(visits_text)), *(visits_text))
+        answer = as_list(
+            ab_page(
+                total,
+                visits_list[-1].ts if visits_list else None,
+                visits_list[0].ts if visits_list else None,
+            ),
+            *(visits_text),
+        )
         if callback_data.action in ["prev", "next"]:
             # Update message for << and >> buttons only
             await callback.message.edit_text(
                 **answer.as_kwargs(),
                 reply_markup=ikb.get_abonement_history_kb(
-                    abonement, offset, limit, total
+                    abonement, visits_list, has_prev, has_next
                 ),
             )
         else:
@@ -249,7 +253,7 @@ async def callbacks_abonement_visits(
             await callback.message.answer(
                 **answer.as_kwargs(),
                 reply_markup=ikb.get_abonement_history_kb(
-                    abonement, offset, limit, total
+                    abonement, visits_list, has_prev, has_next
                 ),
             )
 
@@ -273,15 +277,13 @@ async def callbacks_abonement_edit_delete_select_visits(
             await callback.message.answer(msg["ab_failure_callback"])
         return
     if callback.message and isinstance(callback.message, Message):
-        # Calculate pagination
-        total = await db.abonement_visits_count(abonement.id)
-        limit = await state.get_value(
-            "limit", config["BOT"]["ABONEMENTS"]["PAGINATION_LIMIT"]
-        )
-        offset = await state.get_value("offset", 0)
+        # Current page (saved by history)
+        total = abonement.visits_count
+        limit = config["BOT"]["ABONEMENTS"]["PAGINATION_LIMIT"]
+        cursor = await state.get_value("cursor", "")
         action = callback_data.action
         # Get visits for current page
-        logger.info("Abonement history %s: %s, %s, %s", action, total, limit, offset)
+        logger.info("Abonement history %s: %s, %s, %s", action, total, limit, cursor)
         visits_text = []
         if action == "visit_edit":
             await state.set_state(AbonementGroup.visit_edit)
@@ -294,7 +296,9 @@ async def callbacks_abonement_edit_delete_select_visits(
             return
         # Create message
         answer = as_list(*(visits_text))
-        visits_list = await db.abonement_visits_list(abonement.id, limit, offset)
+        visits_list, _ = await db.abonement_visits_page(
+            abonement.id, limit, ikb.parse_visit_cursor(str(cursor)), "page"
+        )
         await callback.message.edit_reply_markup(None)
         await callback.message.answer(
             **answer.as_kwargs(),
@@ -392,7 +396,7 @@ async def callbacks_abonement_share(
         await callback.message.edit_reply_markup(None)
         await state.set_state(MainGroup.abonement_mode)
         if not abonement.spreadsheet_id:
-            queue_publisher.result(
+            await queue_publisher.result(
                 {
                     "job_type": "abonement_update",
                     "abonement_id": abonement.id,
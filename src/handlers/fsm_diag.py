@@ -14,6 +14,7 @@ from aiogram.utils.formatting import as_numbered_section, as_marked_section
 from datetime import datetime
 from requests.auth import HTTPBasicAuth
 from storage.db_api import Database
+from storage.user_cache import user_cache
 from const.states import MainGroup
 from const.text import cmd, msg, help
 from const.groups import groups
@@ -71,7 +72,9 @@ async def process_diag_command(message: Message, state: FSMContext) -> None:
 async def process_help_command(message: Message):
     logger.info("FSM: diag: help command")
     await message.answer(
-        **Text(as_list(Bold(help["diag_cmd"]), help["diag_info"])).as_kwargs()
+        **Text(
+            as_list(Bold(help["diag_cmd"]), help["diag_info"], help["diag_recount"])
+        ).as_kwargs()
     )
 
 
@@ -126,6 +129,7 @@ async def process_info_command(
             as_key_value("user_id", user_id),
             as_key_value("user_tg_id", user_tg_id),
             as_key_value("user_type", user_type),
+            as_key_value(msg["diag_user_cache"], user_cache.stats()),
         ),
         "",
         as_numbered_section(
@@ -146,6 +150,22 @@ async def process_info_command(
     )
 
 
+# Command /recount in diag state (repair Abonement visit counters)
+@router.message(StateFilter(MainGroup.diag_mode), Command("recount"))
+async def process_recount_command(
+    message: Message, db: Database, user_type: list[str]
+) -> None:
+    logger.info(f"FSM: diag: recount command, user_type={user_type}")
+    if "developer" not in user_type:
+        logger.warning("FSM: diag: no access")
+        await message.answer(msg["no_access"], reply_markup=kb.empty_kb)
+        return
+    abonements_count = await db.abonement_visits_recount()
+    await message.answer(
+        text=msg["diag_recount"] + str(abonements_count), reply_markup=kb.empty_kb
+    )
+
+
 # All other messages in diag state
 @router.message(StateFilter(MainGroup.diag_mode))
 async def process_any_message(message: Message) -> None:
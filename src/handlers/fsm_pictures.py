@@ -181,7 +181,8 @@ async def process_text(
         "output_type": output_type,
     }
     logger.debug(f"FSM: pictures: task '{queue_msg}' prepared")
-    queue_publisher.task(queue_msg)
+    await db.commit()  # worker reads task from DB
+    await queue_publisher.task(queue_msg)
     await message.answer(
         **as_list(msg["pictures_generating"], as_key_value("ID", task.id)).as_kwargs(),
         reply_markup=kb.go_home_kb,
@@ -78,7 +78,11 @@ async def process_selected_table(
         "job_type": "table_generator",
         "job": job,
     }
-    queue_publisher.task(queue_msg)
+    await db.commit()  # worker reads task from DB
+    if job == "all":
+        await queue_publisher.task(queue_msg, queue_publisher.PRIORITY_BATCH)
+    else:
+        await queue_publisher.task(queue_msg)
     await message.answer(
         **as_list(msg["table_generating"], as_key_value("ID", task.id)).as_kwargs(),
         reply_markup=kb.go_home_kb,
@@ -1,4 +1,5 @@
-from typing import Optional, Sequence
+import datetime
+from typing import Optional, Sequence, Tuple
 from aiogram.types import InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters.callback_data import CallbackData
@@ -14,6 +15,43 @@ class AbonementCallbackFactory(CallbackData, prefix="abonement"):
     action: str
 
 
+# Abonement history page Callback factory (cursor of Visit, "" - first page).
+# Abonement is selected by token only: callback data is limited to 64 bytes.
+class AbonementPageCallbackFactory(CallbackData, prefix="abp"):
+    token: str
+    action: str
+    cursor: str
+
+
+CURSOR_EPOCH = datetime.datetime(1970, 1, 1)
+CURSOR_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+# Visit cursor: Visit time (microseconds) and ID in base 36, separated by "."
+def visit_cursor(visit: TgAbonementVisit) -> str:
+    ts = (visit.ts - CURSOR_EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{to_base36(ts)}.{to_base36(visit.id)}"
+
+
+# Visit time and ID from cursor (None for first page or bad cursor)
+def parse_visit_cursor(cursor: str) -> Optional[Tuple[datetime.datetime, int]]:
+    try:
+        ts, visit_id = (int(part, 36) for part in cursor.split("."))
+    except ValueError:
+        return None
+    return CURSOR_EPOCH + datetime.timedelta(microseconds=ts), visit_id
+
+
+# Non-negative number in base 36
+def to_base36(value: int) -> str:
+    digits = ""
+    while True:
+        value, digit = divmod(value, 36)
+        digits = CURSOR_DIGITS[digit] + digits
+        if not value:
+            return digits
+
+
 # ABONEMENT LIST MENU for TgAbonement items
 def get_abonement_items_kb(
     abonements: list[TgAbonement],
@@ -61,8 +99,8 @@ def get_abonement_control_kb(
     # History Button
     builder.button(
         text=cmd["visits_history"],
-        callback_data=AbonementCallbackFactory(
-            id=abonement.id, token=abonement.token, action="history"
+        callback_data=AbonementPageCallbackFactory(
+            token=abonement.token, action="history", cursor=""
         ),
     )
     # Share Button
@@ -127,10 +165,13 @@ def get_abonement_control_kb(
 
 # ABONEMENT HISTORY MENU
 def get_abonement_history_kb(
-    abonement: TgAbonement, offset: int = 0, limit: int = 0, total: int = 0
+    abonement: TgAbonement,
+    visits_list: Sequence[TgAbonementVisit],
+    has_prev: bool = False,
+    has_next: bool = False,
 ) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    if total:
+    if visits_list:
         # Edit Button
         builder.button(
             text=cmd["edit"],
@@ -152,20 +193,24 @@ def get_abonement_history_kb(
             id=abonement.id, token=abonement.token, action="open"
         ),
     )
-    if offset > 0:
+    if visits_list and has_prev:
         # Prev Button
         builder.button(
             text=cmd["prev"],
-            callback_data=AbonementCallbackFactory(
-                id=abonement.id, token=abonement.token, action="prev"
+            callback_data=AbonementPageCallbackFactory(
+                token=abonement.token,
+                action="prev",
+                cursor=visit_cursor(visits_list[0]),
             ),
         )
-    if offset + limit < total:
+    if visits_list and has_next:
         # Next Button
         builder.button(
             text=cmd["next"],
-            callback_data=AbonementCallbackFactory(
-                id=abonement.id, token=abonement.token, action="next"
+            callback_data=AbonementPageCallbackFactory(
+                token=abonement.token,
+                action="next",
+                cursor=visit_cursor(visits_list[-1]),
             ),
         )
     # Exit Button
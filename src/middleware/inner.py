@@ -1,13 +1,16 @@
 import logging
-from typing import Any, Awaitable, Callable, Dict, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, Union
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message
-from storage.db_api import Database
+from storage.audit_log import AuditLog
 
 logger = logging.getLogger(__name__)
 
 
 class StoreAllMessages(BaseMiddleware):
+    def __init__(self, audit_log: AuditLog) -> None:
+        self.audit_log = audit_log
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -15,9 +18,8 @@ class StoreAllMessages(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         logger.info("Begin StoreAllMessages")
-        db: Optional[Database] = data.get("db")
-        if db and isinstance(event, Message):
-            await db.message_to_log(event)
+        if isinstance(event, Message):
+            await self.audit_log.add_message(event)
         result = await handler(event, data)
         logger.info("End StoreAllMessages")
         return result
@@ -1,12 +1,24 @@
 import logging
-from typing import Any, Awaitable, Callable, Dict
+from contextvars import ContextVar
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from aiogram import BaseMiddleware
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.middlewares.base import NextRequestMiddlewareType
+from aiogram.methods.base import Response, TelegramMethod, TelegramType
+from aiogram.fsm.context import FSMContext
 from aiogram.types import TelegramObject
+from storage.audit_log import AuditLog
 from storage.db_api import Database
+from storage.fsm_snapshot import FSMSnapshot
+from storage.user_cache import user_cache
 
 logger = logging.getLogger(__name__)
 
+# Database of update being handled (set by DatabaseMiddleware)
+current_db: ContextVar[Optional[Database]] = ContextVar("current_db", default=None)
+
 
 class DatabaseMiddleware(BaseMiddleware):
     def __init__(self, session: async_sessionmaker[AsyncSession]) -> None:
@@ -19,15 +31,63 @@ class DatabaseMiddleware(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         logger.info("Begin DatabaseMiddleware")
-        async with self.session() as session:
-            db = Database(session=session)
-            data["db"] = db
+        # Session and connection are taken on first query only,
+        # changes of handler are committed once (unit of work)
+        db = Database(session=self.session, unit_of_work=True)
+        data["db"] = db
+        token = current_db.set(db)
+        try:
+            result = await handler(event, data)
+            await db.commit()
+        finally:
+            current_db.reset(token)
+            await db.close()
+        logger.info("End DatabaseMiddleware")
+        return result
+
+
+# Telegram API request middleware: connection of update being handled is
+# returned to pool before request if handler has no pending changes
+# (read-only handlers don't hold connection during Telegram API calls)
+class ReleaseDatabaseMiddleware(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        db = current_db.get()
+        if db:
+            await db.release()
+        return await make_request(bot, method)
+
+
+class FSMSnapshotMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        logger.info("Begin FSMSnapshotMiddleware")
+        state: FSMContext | None = data.get("state")
+        if not state:
+            return await handler(event, data)
+        # Handlers read and change FSM data in memory, it is saved once
+        snapshot = FSMSnapshot(state)
+        data["state"] = snapshot
+        try:
             result = await handler(event, data)
-            logger.info("End DatabaseMiddleware")
-            return result
+        finally:
+            await snapshot.flush()
+        logger.info("End FSMSnapshotMiddleware")
+        return result
 
 
 class StoreAllUpdates(BaseMiddleware):
+    def __init__(self, audit_log: AuditLog) -> None:
+        self.audit_log = audit_log
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -35,9 +95,7 @@ class StoreAllUpdates(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         logger.info("Begin StoreAllUpdates")
-        db: Database | None = data.get("db")
-        if db:
-            await db.event_to_log(event)
+        await self.audit_log.add_update(event)
         result = await handler(event, data)
         logger.info("End StoreAllUpdates")
         return result
@@ -53,7 +111,12 @@ class CheckUserType(BaseMiddleware):
         logger.info("Begin CheckUserType")
         db: Database | None = data.get("db")
         tg_user = data.get("event_from_user")  # stored by built-in aiogram middleware
-        if db and tg_user and tg_user.id:
+        cached = user_cache.get(tg_user.id) if tg_user and tg_user.id else None
+        if cached:
+            data["user_id"], data["user_type"] = cached
+            data["user_tg_id"] = tg_user.id
+            logger.info(f"User {tg_user.id} ({data['user_id']}) is {data['user_type']}")
+        elif db and tg_user and tg_user.id:
             user = await db.user_get_or_create(tg_user=tg_user)
             if not user:
                 logger.warning(f"User {tg_user.id} not found in DB")
@@ -61,6 +124,10 @@ class CheckUserType(BaseMiddleware):
                 data["user_type"] = db.user_get_groups(user)
                 data["user_tg_id"] = user.tg_id
                 data["user_id"] = user.id
+                # New user is flushed only: cache it when it is committed
+                db.after_commit(
+                    partial(user_cache.set, user.tg_id, user.id, data["user_type"])
+                )
                 logger.info(f"User {user.tg_id} ({user.id}) is {data['user_type']}")
         result = await handler(event, data)
         logger.info("End CheckUserType")
@@ -5,7 +5,7 @@ from typing import Optional
 from aiogram.utils.formatting import Text, Bold, Italic, Code
 from aiogram.utils.formatting import as_list, as_numbered_section, as_key_value
 from const.text import cmd, msg
-from const.formats import date_fmt
+from const.formats import date_fmt, date_h_m_fmt
 
 
 # Register new user: begin
@@ -120,18 +120,20 @@ def ab_info(
     return res
 
 
-# Abonement: page with visits
-def ab_page(offset: int, total: int, visits: int) -> Text:
+# Abonement: page with visits (from oldest to newest visit on page)
+def ab_page(
+    total: int, oldest: Optional[datetime] = None, newest: Optional[datetime] = None
+) -> Text:
     res = (
         Text(
             "📈 Проходы с ",
-            Bold(offset + 1),
+            Bold(oldest.strftime(date_h_m_fmt)),
             " по ",
-            Bold(offset + visits),
-            " из ",
+            Bold(newest.strftime(date_h_m_fmt)),
+            ", всего ",
             Bold(total),
         )
-        if total > 0
+        if total > 0 and oldest and newest
         else Text("✨ Проходов пока не было.")
     )
     return res
@@ -1,47 +1,154 @@
+import io
 import os
 import logging
-import tempfile
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
 from PIL import Image, ImageDraw, ImageFont
 from modules import queue_publisher
+from storage.artifact_store import artifact_store, render_key
 
 logger = logging.getLogger(__name__)
 
+FONT_MIN_SIZE = 10
+FONT_MAX_SIZE = 129
+FONT_REFERENCE_SIZE = 100  # size of font used to estimate fitting size
+JPEG_MIN_QUALITY = 10
+JPEG_MAX_QUALITY = 95
+JPEG_PROBE_FACTOR = 4  # probe image is downscaled by this factor
+
+# Last JPEG quality that fitted max size, by picture template (per process)
+jpeg_qualities: dict[str, int] = {}
+
+
+# Font of selected size (cached per process)
+@lru_cache(maxsize=256)
+def load_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_path, size)
+
+
+# Decoded and resized background (cached per process, copy before drawing)
+@lru_cache(maxsize=16)
+def load_background(src_img: str, width: int, height: int) -> Image.Image:
+    logger.info("Loading background %s...", src_img)
+    with Image.open(src_img) as image:
+        return image.resize((width, height))
+
+
+# Encode image to JPEG in memory
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+# Highest quality in low..high for which check passes (binary search),
+# low - 1 if none passes
+def search_quality(check: Callable[[int], bool], low: int, high: int) -> int:
+    while low <= high:
+        quality = (low + high) // 2
+        if check(quality):
+            low = quality + 1
+        else:
+            high = quality - 1
+    return high
+
 
 # Generate text on image
 class PictureCreator:
     def __init__(self):
         pass
 
-    # Save image with selected quality
-    def save_image_with_quality(self, image: Image.Image, quality: int) -> str:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            temp_path = temp_file.name
-            image.save(temp_path, format="JPEG", quality=quality, optimize=True)
-        return temp_path
-
-    # Save image with selected maximum size
-    def save_image_with_max_size(self, image: Image.Image, max_size: int) -> str:
-        low, high = 10, 95  # Quality range
-        best_quality = high
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            temp_path = temp_file.name
-            while low <= high:
-                quality = (low + high) // 2
-                image.save(temp_path, format="JPEG", quality=quality, optimize=True)
-                file_size = os.path.getsize(temp_path)
-                if file_size <= max_size:
-                    best_quality = quality
-                    low = quality + 1
-                else:
-                    high = quality - 1
-            # Save image with optimal quality
-            image.save(temp_path, format="JPEG", quality=best_quality, optimize=True)
-        return temp_path
-
-    # Generate image with text
+    # Encode image with selected maximum size. Quality that fitted the same
+    # template before is the starting estimate (see fit_quality).
+    def encode_with_max_size(
+        self, image: Image.Image, max_size: int, template: Optional[str] = None
+    ) -> bytes:
+        start = jpeg_qualities.get(template) if template else None
+        quality, data = self.fit_quality(image, max_size, start)
+        if template:
+            jpeg_qualities[template] = quality
+        logger.info("JPEG quality %d, size %d (max %d)", quality, len(data), max_size)
+        return data
+
+    # Highest quality with JPEG data within max size (lowest if none fits).
+    # Quality is estimated with downscaled probe image (unless start estimate
+    # is given), full image is encoded only near the estimate.
+    def fit_quality(
+        self, image: Image.Image, max_size: int, start: Optional[int] = None
+    ) -> Tuple[int, bytes]:
+        probe = image.reduce(JPEG_PROBE_FACTOR)
+        probe_sizes: dict[int, int] = {}
+        encoded: dict[int, bytes] = {}
+
+        def probe_size(quality: int) -> int:
+            if quality not in probe_sizes:
+                probe_sizes[quality] = len(encode_jpeg(probe, quality))
+            return probe_sizes[quality]
+
+        def fits(quality: int) -> bool:
+            if quality not in encoded:
+                encoded[quality] = encode_jpeg(image, quality)
+            return len(encoded[quality]) <= max_size
+
+        def estimate(ratio: float) -> int:
+            quality = search_quality(
+                lambda q: probe_size(q) * ratio <= max_size,
+                JPEG_MIN_QUALITY,
+                JPEG_MAX_QUALITY,
+            )
+            return max(quality, JPEG_MIN_QUALITY)
+
+        if start:
+            quality = min(max(start, JPEG_MIN_QUALITY), JPEG_MAX_QUALITY)
+        else:
+            # Estimate by probe, correct ratio (full size / probe size) by full image
+            quality = estimate(JPEG_PROBE_FACTOR**2)
+            fits(quality)
+            quality = estimate(len(encoded[quality]) / probe_size(quality))
+        # Expand range from estimate until quality is bracketed, then search
+        low, high = JPEG_MIN_QUALITY - 1, JPEG_MAX_QUALITY + 1  # fits, too big
+        step = 1
+        while low < quality < high:
+            if fits(quality):
+                low = quality
+                quality += step
+            else:
+                high = quality
+                quality -= step
+            step *= 2
+        low = search_quality(fits, low + 1, high - 1)
+        quality = max(low, JPEG_MIN_QUALITY)
+        fits(quality)
+        return quality, encoded[quality]
+
+    # Largest font size (FONT_MIN_SIZE..FONT_MAX_SIZE) with text narrower
+    # than max width, FONT_MIN_SIZE - 1 if text is too wide. Size is estimated
+    # by text length in reference font and checked by binary search.
+    def fit_font_size(
+        self, draw: ImageDraw.ImageDraw, text: str, font_path: str, max_width: int
+    ) -> int:
+        reference = load_font(font_path, FONT_REFERENCE_SIZE)
+        length = draw.textlength(text, font=reference)
+        estimate = (
+            int(FONT_REFERENCE_SIZE * max_width / length) if length else FONT_MAX_SIZE
+        )
+        probes = [estimate, estimate + 1]
+        low, high = FONT_MIN_SIZE - 1, FONT_MAX_SIZE + 1  # low fits, high doesn't
+        while high - low > 1:
+            size = probes.pop(0) if probes else (low + high) // 2
+            if not low < size < high:
+                continue
+            font = load_font(font_path, size)
+            if draw.textlength(text, font=font) < max_width:
+                low = size
+            else:
+                high = size
+        return low
+
+    # Generate image with text (JPEG data)
     def generate_image(
         self, img_params: dict, lines: list[str], src_img: str, font_path: str
-    ) -> str:
+    ) -> bytes:
         # Set image parameters
         width = img_params["width"]
         height = img_params["height"]
@@ -49,24 +156,17 @@ class PictureCreator:
         line_spacing = 15
 
         # Prepare background
-        background = Image.open(src_img).resize((width, height))
+        background = load_background(src_img, width, height).copy()
         draw = ImageDraw.Draw(background)
 
         # Prepare text
         lines_cnt = len(lines)
-        font_size_line = [10, 10]
-        font_line = [ImageFont.truetype(font_path), ImageFont.truetype(font_path)]
+        font_line = [load_font(font_path, 10), load_font(font_path, 10)]
 
         # Select font size
         for id in range(min(2, lines_cnt)):
-            for _ in range(120):
-                font_line[id] = ImageFont.truetype(font_path, font_size_line[id])
-                if draw.textlength(lines[id], font=font_line[id]) < max_width:
-                    font_size_line[id] += 1
-                else:
-                    font_size_line[id] -= 1
-                    font_line[id] = ImageFont.truetype(font_path, font_size_line[id])
-                    break
+            font_size = self.fit_font_size(draw, lines[id], font_path, max_width)
+            font_line[id] = load_font(font_path, font_size)
 
         # First line: draw text
         caption_height = draw.textbbox((0, 0), lines[0], font=font_line[0])[3] + (
@@ -94,28 +194,46 @@ class PictureCreator:
                 fill="white",
             )
 
-        # Save image to temporary file
-        temp_path = self.save_image_with_quality(background, 95)
-        return temp_path
+        # Encode image (within max size if selected)
+        max_size = img_params.get("max-size")
+        if max_size:
+            return self.encode_with_max_size(
+                background, max_size, template=img_params.get("file")
+            )
+        return encode_jpeg(background, JPEG_MAX_QUALITY)
+
+    # Stored picture for task: the same picture and text are rendered once,
+    # result is kept in artifact store
+    def get_image(self, msg: dict) -> str:
+        key = render_key(msg["picture"], msg["lines"])
+        artifact = artifact_store.resolve(key)
+        if artifact:
+            logger.info("Picture found in artifact store: %s", artifact)
+            return artifact
+        data = self.generate_image(
+            img_params=msg["picture"],
+            lines=msg["lines"],
+            src_img=os.path.join("static", "pictures", msg["picture"]["file"]),
+            font_path=os.path.join("static", "fonts", msg["picture"]["font"]),
+        )
+        artifact = artifact_store.put(data, suffix=".jpg")
+        artifact_store.link(key, artifact)
+        return artifact
 
     # Handle new task from RabbitMQ
     def handle_new_task(self, msg: dict) -> None:
         logger.info("Generate picture...")
         logger.info("Source: {}".format(msg))
         try:
-            # Generate picture
-            generated_image_path = self.generate_image(
-                img_params=msg["picture"],
-                lines=msg["lines"],
-                src_img=os.path.join("static", "pictures", msg["picture"]["file"]),
-                font_path=os.path.join("static", "fonts", msg["picture"]["font"]),
-            )
-            logger.info("Saved image to {}".format(generated_image_path))
+            # Generate picture (or take stored one)
+            artifact = self.get_image(msg)
+            logger.info("Stored image {}".format(artifact))
+            artifact_store.evict()
             # Publish result
             msg["uuid"] = msg.get("uuid", "no_uuid")
-            msg["image"] = generated_image_path
+            msg["artifact"] = artifact
             msg["result"] = "done"
-            queue_publisher.result(msg)
+            queue_publisher.result_blocking(msg)
             logger.info("Result: {}".format(msg))
             logger.info("Done image generating!")
         except Exception as e:
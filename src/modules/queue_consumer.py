@@ -2,40 +2,111 @@ import asyncio
 import pika
 import logging
 import logging.handlers
+from typing import Optional
 from pika.adapters.asyncio_connection import AsyncioConnection
-from modules.queue_handler import QueueHandler
+from modules.queue_handler import QueueHandler, QueueJob
 
 logger = logging.getLogger(__name__)
 
 
+# Locks by key (jobs with the same key never run concurrently)
+class KeyedLock:
+    def __init__(self):
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.users: dict[str, int] = {}
+
+    async def acquire(self, key: str) -> None:
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.users[key] = self.users.get(key, 0) + 1
+        await lock.acquire()
+
+    def release(self, key: str) -> None:
+        self.locks[key].release()
+        self.users[key] -= 1
+        if not self.users[key]:
+            del self.users[key]
+            del self.locks[key]
+
+
+# Ack each delivery on its own completion (jobs with the same key are
+# ordered by KeyedLock), acks for closed channel are dropped
+class Acker:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def complete(self, delivery_tag: int) -> None:
+        if not self.channel.is_open:
+            logger.warning("Channel closed, can't ack message %s", delivery_tag)
+            return
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+        logger.info("Message %s acked", delivery_tag)
+
+
 class QueueConsumer:
-    def __init__(self, url, queue_name, bot_token, admin_id, session_maker):
+    def __init__(
+        self, url, queue_name, bot_token, admin_id, session_maker, concurrency=1
+    ):
         self.url = url
         self.queue_name = queue_name
+        self.concurrency = max(1, concurrency)
         self.connection = None
         self.channel = None
+        self.acker: Optional[Acker] = None
         self.handler = QueueHandler(bot_token, admin_id, session_maker)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.keyed_lock = KeyedLock()
+        self.tasks: set[asyncio.Task] = set()
+        self.consumer_tag: Optional[str] = None
+        self.stopping = asyncio.Event()
 
     # Handle messages from RabbitMQ queue
-    async def on_message_async(self, channel, method, properties, body):
+    async def on_message_async(self, acker, delivery_tag, body):
         logger.info("Async handler started...")
-        self.handler.convert_rabbitmq_message(body)  # sync handler (first)
-        logger.info("Create notification...")
-        await self.handler.create_notification()  # async handler (second)
-        channel.basic_ack(delivery_tag=method.delivery_tag)
-        logger.info("Message acked")
+        job = self.handler.convert_rabbitmq_message(body)
+        try:
+            if job:
+                await self.process_job(job)
+        except Exception:
+            logger.error("Error processing message %s", delivery_tag, exc_info=True)
+        acker.complete(delivery_tag)
+
+    # Process job (keep order for jobs with the same key)
+    async def process_job(self, job: QueueJob) -> None:
+        if job.key:
+            await self.keyed_lock.acquire(job.key)
+        try:
+            async with self.semaphore:
+                logger.info("Create notification...")
+                await self.handler.create_notification(job)
+        finally:
+            if job.key:
+                self.keyed_lock.release(job.key)
 
     async def start(self):
         logger.info("Create connection...")
         self.connection = self.connect()
         logger.info("Connection created")
-        await asyncio.Future()  # Keep the event loop running
+        await self.stopping.wait()  # Keep the event loop running
+
+    # Request shutdown (start returns)
+    def shutdown(self):
+        logger.info("Shutdown requested")
+        self.stopping.set()
 
     def stop(self):
         if self.connection and not self.connection.is_closed:
             self.connection.close()
         logger.info("Connection closed")
 
+    # Stop consuming, wait for running jobs (acked while connection is open),
+    # flush buffered changes and close Bot session
+    async def close(self):
+        if self.channel and self.channel.is_open and self.consumer_tag:
+            self.channel.basic_cancel(self.consumer_tag)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.handler.close()
+
     def connect(self):
         return AsyncioConnection(
             pika.URLParameters(self.url),
@@ -59,7 +130,8 @@ class QueueConsumer:
     def on_channel_open(self, channel):
         logger.info("Channel opened")
         self.channel = channel
-        self.channel.basic_qos(prefetch_count=1)
+        self.acker = Acker(channel)
+        self.channel.basic_qos(prefetch_count=self.concurrency)
         self.channel.queue_declare(
             queue=self.queue_name, callback=self.on_queue_declared
         )
@@ -67,13 +139,16 @@ class QueueConsumer:
     def on_queue_declared(self, method_frame):
         logger.info("Queue declared")
         if self.channel:
-            self.channel.basic_consume(
+            self.consumer_tag = self.channel.basic_consume(
                 queue=self.queue_name, on_message_callback=self.on_message
             )
 
     def on_message(self, channel, method, properties, body):
         logger.info(f"Received message: {body.decode()}")
-        loop = asyncio.get_event_loop()
-        asyncio.run_coroutine_threadsafe(
-            self.on_message_async(channel, method, properties, body), loop
+        if not self.acker:
+            return
+        task = asyncio.get_event_loop().create_task(
+            self.on_message_async(self.acker, method.delivery_tag, body)
         )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
@@ -1,22 +1,54 @@
+import asyncio
 import os
 import json
 import logging
 import logging.handlers
+from dataclasses import dataclass
+from typing import Optional
 from aiogram import Bot
 from aiogram.enums import ParseMode
-from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputFile
 from aiogram.client.default import DefaultBotProperties
 from aiogram.utils.formatting import Text, TextLink, as_key_value, as_list
 from const.text import msg
 from const.formats import date_fmt, date_h_m_fmt
 from storage.db_schema import TgUser
 from storage.db_api import Database
-from utils.config import tables
-from utils.google_api import GoogleApi
+from storage.artifact_store import artifact_store
+from modules.visit_sync import VisitSync
+from utils.config import config, tables
+from utils.google_api import GoogleApi, VisitChange, EDITED_COLOR, DELETED_COLOR
 
 logger = logging.getLogger(__name__)
 
 
+# Decoded RabbitMQ message (one per delivery)
+@dataclass(frozen=True)
+class QueueJob:
+    job_type: Optional[str] = None
+    pending: str = ""
+    task_id: int = -1
+    msg_text: str = ""
+    file_path: str = ""
+    artifact: str = ""
+    abonement_id: Optional[int] = None
+    user_tg_id: Optional[int] = None
+    msg_type: Optional[str] = None
+    visit_id: Optional[int] = None
+    visit_user_id: Optional[int] = None
+    user_id: Optional[int] = None
+    ts: Optional[str] = None
+    ts_new: Optional[str] = None
+
+    # Jobs with the same key are processed one by one
+    @property
+    def key(self) -> Optional[str]:
+        if self.abonement_id:
+            return f"abonement_{self.abonement_id}"
+        return None
+
+
 class QueueHandler:
     def __init__(self, token, admin_id, session_maker):
         self.admin_id = admin_id
@@ -24,59 +56,118 @@ class QueueHandler:
         self.bot = Bot(
             token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML)
         )
+        self.visit_sync = VisitSync(
+            config["GOOGLE"].get("SYNC_DELAY", 3),
+            max_delay=config["GOOGLE"].get("SYNC_MAX_DELAY", 300),
+        )
 
     # Send text message
     async def sendText(self, chat_id: int, text: str) -> bool:
         res = await self.bot.send_message(chat_id, text)
         return res is not None
 
-    # Send picture
-    async def sendPicture(self, chat_id: int, text: str, path: str) -> bool:
-        file = FSInputFile(path)
+    # Send picture (file or Telegram file_id), returns file_id
+    async def sendPicture(
+        self, chat_id: int, text: str, file: InputFile | str
+    ) -> Optional[str]:
         res = await self.bot.send_photo(chat_id, photo=file, caption=text)
-        return res is not None
+        return res.photo[-1].file_id if res and res.photo else None
 
-    # Send document
-    async def sendDocument(self, chat_id: int, text: str, path: str) -> bool:
-        file = FSInputFile(path)
+    # Send document (file or Telegram file_id), returns file_id
+    async def sendDocument(
+        self, chat_id: int, text: str, file: InputFile | str
+    ) -> Optional[str]:
         res = await self.bot.send_document(chat_id, document=file, caption=text)
-        return res is not None
+        return res.document.file_id if res and res.document else None
+
+    # Send picture or document by pending type
+    async def sendFile(
+        self, chat_id: int, text: str, kind: str, file: InputFile | str
+    ) -> Optional[str]:
+        if kind == "picture":
+            return await self.sendPicture(chat_id, text, file)
+        return await self.sendDocument(chat_id, text, file)
+
+    # Send artifact: by Telegram file_id if it was uploaded before,
+    # otherwise uploaded from artifact store (file_id is stored for reuse)
+    async def sendArtifact(
+        self, chat_id: int, text: str, kind: str, artifact: str
+    ) -> bool:
+        file_id = artifact_store.file_id(artifact, kind)
+        if file_id:
+            try:
+                await self.sendFile(chat_id, text, kind, file_id)
+                logger.info("Artifact %s sent by file_id", artifact)
+                return True
+            except TelegramBadRequest:
+                logger.warning("File_id of %s rejected, uploading...", artifact)
+        path = artifact_store.get_path(artifact)
+        if not path:
+            logger.warning("Artifact %s not found in store", artifact)
+            return False
+        file_id = await self.sendFile(chat_id, text, kind, FSInputFile(path))
+        if file_id:
+            artifact_store.set_file_id(artifact, kind, file_id)
+        return file_id is not None
+
+    # Send temporary file (results of old workers), file is deleted anyway
+    async def sendTempFile(self, chat_id: int, text: str, kind: str, path: str) -> bool:
+        try:
+            return (
+                await self.sendFile(chat_id, text, kind, FSInputFile(path)) is not None
+            )
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info("File %s deleted", path)
+
+    # Create Abonement spreadsheet (all Google API calls in one thread)
+    def create_spreadsheet(self, google: GoogleApi, name: str) -> Optional[str]:
+        google.auth()
+        google.prepareFolder()
+        spreadsheet_id = google.createFromTemplate(name)
+        if spreadsheet_id:
+            google.setAccess()
+        return spreadsheet_id
 
     # Notify users about Abonement Update
-    async def notify_abonement_update(self, need_notify=False) -> bool:
+    async def notify_abonement_update(self, job: QueueJob, need_notify=False) -> bool:
         logger.info("Prepare notification Abonement Update...")
         res = False
+        google = GoogleApi()
         # Get data from DB
         async with self.AsyncSessionLocal() as session:
             db = Database(session=session)
-            if not self.abonement_id:
+            if not job.abonement_id:
                 logger.warning("Abonement ID not set")
                 return False
-            abonement = await db.abonement_by_id(self.abonement_id)
+            abonement = await db.abonement_by_id(job.abonement_id)
             if not abonement or abonement.hidden:
-                logger.warning("Abonement %s bad", self.abonement_id)
+                logger.warning("Abonement %s bad", job.abonement_id)
                 return False
             # Check Abonement spreadsheet ID
             spreadsheet_id = abonement.spreadsheet_id
             if not spreadsheet_id:
                 # Create spreadsheet if not exists
-                logger.info("Abonement %s has no spreadsheet", self.abonement_id)
-                self.google.prepareFolder()
-                spreadsheet_id = self.google.createFromTemplate(abonement.name)
+                logger.info("Abonement %s has no spreadsheet", job.abonement_id)
+                spreadsheet_id = await asyncio.to_thread(
+                    self.create_spreadsheet, google, abonement.name
+                )
                 if not spreadsheet_id:
                     logger.error("Can't create spreadsheet")
                     return False
-                self.google.setAccess()
                 # Update Abonement spreadsheet id in DB
-                await db.abonement_edit_spreadsheetid(self.abonement_id, spreadsheet_id)
+                await db.abonement_edit_spreadsheetid(job.abonement_id, spreadsheet_id)
             # Update Abonement information in spreadsheet
-            logger.info("Update Abonement %s in %s", self.abonement_id, spreadsheet_id)
+            logger.info("Update Abonement %s in %s", job.abonement_id, spreadsheet_id)
             abonement_owner = await db.user_by_id(abonement.owner_id)
             if not abonement_owner:
-                logger.warning("Abonement %s has bad owner", self.abonement_id)
+                logger.warning("Abonement %s has bad owner", job.abonement_id)
                 return False
-            self.google.setSpreadsheetId(spreadsheet_id)
-            self.google.abonementUpdate(
+            google.setSpreadsheetId(spreadsheet_id)
+            await db.release()  # no connection held during Google API calls
+            await asyncio.to_thread(
+                google.abonementUpdate,
                 abonement.name,
                 abonement.token,
                 (
@@ -88,329 +179,300 @@ class QueueHandler:
                 abonement.description if abonement.description else "",
                 abonement_owner.name,
             )
-            # Sync Abonement Visits (first 1000 visits)
-            abonement_visits = await db.abonement_visits_list(abonement.id, desc=False)
-            if not abonement_visits:
-                logger.info("Abonement %s has no visits", self.abonement_id)
-            else:
-                logger.info("Abonement has %s visit(s)", len(abonement_visits))
-                visits = list()
-                for visit in abonement_visits:
-                    user = await db.user_by_id(visit.user_id)
-                    visits.append(
-                        (
-                            visit.id,
-                            visit.ts.strftime(date_h_m_fmt),
-                            user.name if user and user.name else "",
-                        )
-                    )
-                self.google.visitsUpdateAll(visits)
+            # Sync Abonement Visits (by chunks)
+            await self.visit_sync.flush(spreadsheet_id)
+            async with self.visit_sync.lock(spreadsheet_id):
+                rows = None
+                visits_count = 0
+                async for chunk in db.abonement_visits_stream(abonement.id):
+                    visits = [
+                        (visit_id, ts.strftime(date_h_m_fmt), user_name or "")
+                        for visit_id, ts, user_name in chunk
+                    ]
+                    visits_count += len(visits)
+                    rows = await asyncio.to_thread(google.visitsUpdateAll, visits, rows)
+                logger.info("Abonement has %s visit(s)", visits_count)
             # Notify user
             if not need_notify:
                 logger.info("Skip sending link to user")
                 return True
             logger.info("Notify user")
             try:
-                if not self.user_tg_id:
+                if not job.user_tg_id:
                     logger.warning("User Telegram ID not set")
                     return False
-                user = await db.user_by_tg_id(self.user_tg_id)
+                user = await db.user_by_tg_id(job.user_tg_id)
                 if not user:
-                    logger.warning("User %s not found", self.user_tg_id)
+                    logger.warning("User %s not found", job.user_tg_id)
                     return False
                 # Store Notification to DB
                 logger.info("Store Notification for user %s", user.id)
-                await db.notification_add(user, self.google.getLink())
+                await db.notification_add(user, google.getLink())
                 # Send Notification to Telegram
                 logger.info("Send notification to user %s", user.tg_id)
-                res = await self.sendText(user.tg_id, self.google.getLink())
+                res = await self.sendText(user.tg_id, google.getLink())
             except Exception:
-                logger.warning("Error sending to %s", self.user_tg_id, exc_info=True)
+                logger.warning("Error sending to %s", job.user_tg_id, exc_info=True)
         return res
 
     # Notify users about new Abonement Visit
-    async def notify_abonement_visit(self) -> bool:
+    async def notify_abonement_visit(self, job: QueueJob) -> bool:
         logger.info("Prepare notification Abonement Visit...")
         res = False
+        if not job.abonement_id or not job.visit_id or not job.user_id:
+            logger.warning("Wrong data")
+            return False
+        if not job.visit_user_id:
+            logger.warning("Visit User not set")
+            return False
         # Get data from DB
         async with self.AsyncSessionLocal() as session:
             db = Database(session=session)
-            abonent_users_list: list[TgUser] = []
-            if db and self.abonement_id and self.visit_id and self.user_id:
-                # Get actor (visitor/editor/deleter)
-                actor_user_id = self.user_id
-                actor_user = await db.user_by_id(actor_user_id)
-                if actor_user:
-                    logger.info("Action performed by user %s", actor_user.id)
-                else:
-                    logger.warning("Action performed by bad user %s", actor_user_id)
-                    return False
-                # Get Abonement
-                abonement_id = self.abonement_id
-                abonement = await db.abonement_by_id(abonement_id)
-                if abonement and not abonement.hidden:
-                    logger.info("Abonement %s found", abonement.id)
-                    # Get Abonement owner
-                    owner = await db.user_by_id(abonement.owner_id)
-                    if owner:
-                        abonent_users_list.append(owner)
-                        logger.info("Abonement owner %s found", owner.id)
-                    else:
-                        logger.warning("Abonement owner %s bad", abonement.owner_id)
-                        return False
-                    # Get Abonement users
-                    abonement_users = await db.abonement_users(abonement_id)
-                    for abonement_user in abonement_users:
-                        if not abonement_user or not abonement_user.user_id:
-                            continue
-                        user = await db.user_by_id(abonement_user.user_id)
-                        if not user:
-                            continue
-                        logger.info("Abonement user %s found", user.id)
-                        abonent_users_list.append(user)
-                else:
-                    logger.warning("Abonement %s bad", abonement_id)
-                    return False
-                # Get Abonement Visit
-                visit_id = self.visit_id
-                visit = await db.abonement_visit_get(visit_id)
-                if visit:
-                    logger.info("Abonement Visit %s found", visit.id)
-                    visit_user_id = visit.user_id
-                    visit_user = await db.user_by_id(visit_user_id)
-                    if visit_user:
-                        logger.info("Abonement Visit user %s found", visit_user.id)
-                    else:
-                        logger.warning("Abonement Visit user %s bad", visit_user_id)
-                        return False
-                else:
-                    logger.warning("Abonement Visit %s bad", visit_id)
-                # Get Abonement Visit User
-                if not self.visit_user_id:
-                    logger.warning("Visit User not set")
-                    return False
-                visit_user_id = self.visit_user_id
-                visit_user = await db.user_by_id(visit_user_id)
-                if visit_user:
-                    logger.info("Abonement Visit user %s", visit_user.id)
-                else:
-                    logger.warning("Abonement Visit bad user %s", visit_user_id)
-                    return False
-                # Add/update/delete Abonement Visit in Google Sheet
-                if abonement.spreadsheet_id:
-                    logger.info("Use Sheet ID: %s", abonement.spreadsheet_id)
-                    self.google.setSpreadsheetId(abonement.spreadsheet_id)
-                    if self.msg_type == "visit_new":
-                        self.google.visitAdd(
-                            visit_id,
-                            self.ts,
-                            visit_user.name if visit_user and visit_user.name else "",
-                        )
-                    elif self.msg_type == "visit_edit":
-                        self.google.visitUpdate(visit_id, self.ts_new)
-                    elif self.msg_type == "visit_delete":
-                        self.google.visitDelete(visit_id)
-            else:
-                logger.warning("Wrong db connection or wrong data")
+            # Get Abonement, its users and their notification settings
+            setting_name = "notify_abonement_%s" % job.abonement_id
+            info = await db.abonement_notify_info(job.abonement_id, setting_name)
+            if not info or info[0].hidden:
+                logger.warning("Abonement %s bad", job.abonement_id)
                 return False
-
-            # Got Abonement users
-            if not abonent_users_list:
-                logger.info("No users found for Abonement")
+            abonement, visits_count, abonement_users = info
+            logger.info("Abonement %s found", abonement.id)
+            users = {user.id: user for user, _ in abonement_users}
+            if abonement.owner_id not in users:
+                logger.warning("Abonement owner %s bad", abonement.owner_id)
                 return False
+            logger.info(f"Found {len(abonement_users)} user(s) for Abonement")
+            # Get actor (visitor/editor/deleter)
+            actor_user = users.get(job.user_id) or await db.user_by_id(job.user_id)
+            if actor_user:
+                logger.info("Action performed by user %s", actor_user.id)
             else:
-                logger.info(f"Found {len(abonent_users_list)} user(s) for Abonement")
+                logger.warning("Action performed by bad user %s", job.user_id)
+                return False
+            # Get Abonement Visit User
+            visit_user = users.get(job.visit_user_id) or await db.user_by_id(
+                job.visit_user_id
+            )
+            if visit_user:
+                logger.info("Abonement Visit user %s", visit_user.id)
+            else:
+                logger.warning("Abonement Visit bad user %s", job.visit_user_id)
+                return False
+            # Add/update/delete Abonement Visit in Google Sheet (write-behind)
+            visit_id = job.visit_id
+            if abonement.spreadsheet_id:
+                logger.info("Use Sheet ID: %s", abonement.spreadsheet_id)
+                change = None
+                if job.msg_type == "visit_new":
+                    change = VisitChange(
+                        visit_id,
+                        ts=job.ts,
+                        user_name=visit_user.name if visit_user.name else "",
+                        new=True,
+                    )
+                elif job.msg_type == "visit_edit":
+                    change = VisitChange(visit_id, ts=job.ts_new, color=EDITED_COLOR)
+                elif job.msg_type == "visit_delete":
+                    change = VisitChange(visit_id, deleted=True, color=DELETED_COLOR)
+                if change:
+                    self.visit_sync.add(abonement.spreadsheet_id, change)
 
             # Check notification settings
-            setting_name = "notify_abonement_%s" % abonement.id
             logger.info("Read settings: %s", setting_name)
             notify_users_list: list[TgUser] = []
-            for user in abonent_users_list:
+            for user, notifications in abonement_users:
                 if not user or not user.id or user.id == actor_user.id:
                     continue
-                notifications = await db.settings_value(user.id, setting_name)
                 if notifications in ["all"]:
                     notify_users_list.append(user)
+            left_visits = (
+                abonement.total_visits - visits_count
+                if abonement.total_visits
+                else None
+            )
+
+            # Create message by lines
+            msg_text = ""
+            visit_user_name = None
+            tokens = []
+            actor_link = TextLink(
+                actor_user.name, url=f"tg://user?id={actor_user.tg_id}"
+            )
+            if job.msg_type == "visit_new":
+                msg_text = msg["ab_notify_visit_new"]
+            elif job.msg_type == "visit_edit":
+                msg_text = msg["ab_notify_visit_edit"]
+                visit_user_name = visit_user.name
+            elif job.msg_type == "visit_delete":
+                msg_text = msg["ab_notify_visit_delete"]
+                visit_user_name = visit_user.name
+            else:
+                msg_text = msg["unknown"]
+            tokens.append(Text(msg_text))
+            tokens.append(as_key_value(msg["name"], abonement.name))
+            if left_visits is not None:
+                tokens.append(as_key_value(msg["ab_left_visits"], left_visits))
+            if job.ts_new and job.ts:
+                tokens.append(Text(job.ts, " >> ", job.ts_new))
+            elif job.ts:
+                tokens.append(as_key_value(msg["ab_notify_date"], job.ts))
+            if visit_user_name:
+                tokens.append(as_key_value(msg["ab_notify_visitor"], visit_user_name))
+                tokens.append(as_key_value(msg["ab_notify_actor"], actor_link))
+            else:
+                tokens.append(as_key_value(msg["ab_notify_visitor"], actor_link))
+            text = as_list(*tokens).as_html()
+
+            # Store Notifications to DB
+            notify_users_list = [user for user in notify_users_list if user.tg_id]
+            logger.info("Store %s Notification(s)", len(notify_users_list))
+            await db.notifications_add(
+                [
+                    (user, msg_text + " %s %s" % (abonement.name, user.name))
+                    for user in notify_users_list
+                ]
+            )
 
             # Notifiations
-            logger.info("Notify %s, type: %s", len(notify_users_list), self.msg_type)
+            await db.release()  # no connection held during Telegram API calls
+            logger.info("Notify %s, type: %s", len(notify_users_list), job.msg_type)
             for user in notify_users_list:
-                if not user or not user.tg_id:
-                    continue
-                # Create notification for each user
+                # Send Notification to Telegram
                 try:
                     logger.info("Notify user %s (%s)", user.id, user.tg_id)
-                    msg_text = ""
-                    visit_user_name = None
-                    tokens = []
-                    left_visits = await db.abonement_visits_left(abonement)
-                    actor_link = TextLink(
-                        actor_user.name, url=f"tg://user?id={actor_user.tg_id}"
-                    )
-                    if self.msg_type == "visit_new":
-                        msg_text = msg["ab_notify_visit_new"]
-                    elif self.msg_type == "visit_edit":
-                        msg_text = msg["ab_notify_visit_edit"]
-                        visit_user_name = visit_user.name
-                    elif self.msg_type == "visit_delete":
-                        msg_text = msg["ab_notify_visit_delete"]
-                        visit_user_name = visit_user.name
-                    else:
-                        msg_text = msg["unknown"]
-                    # Create message by lines
-                    tokens.append(Text(msg_text))
-                    tokens.append(as_key_value(msg["name"], abonement.name))
-                    if left_visits is not None:
-                        tokens.append(as_key_value(msg["ab_left_visits"], left_visits))
-                    if self.ts_new and self.ts:
-                        tokens.append(Text(self.ts, " >> ", self.ts_new))
-                    elif self.ts:
-                        tokens.append(as_key_value(msg["ab_notify_date"], self.ts))
-                    if visit_user_name:
-                        tokens.append(
-                            as_key_value(msg["ab_notify_visitor"], visit_user_name)
-                        )
-                        tokens.append(as_key_value(msg["ab_notify_actor"], actor_link))
-                    else:
-                        tokens.append(
-                            as_key_value(msg["ab_notify_visitor"], actor_link)
-                        )
-                    # Store Notification to DB
-                    logger.info("Store Notification for user %s", user.id)
-                    await db.notification_add(
-                        user, msg_text + " %s %s" % (abonement.name, user.name)
-                    )
-                    # Send Notification to Telegram
-                    logger.info("Send notification to user %s", user.tg_id)
-                    res = await self.sendText(user.tg_id, as_list(*tokens).as_html())
+                    res = await self.sendText(user.tg_id, text)
                 except Exception:
                     logger.warning("Error sending to %s", user.tg_id, exc_info=True)
 
-        # Close Bot session
-        await self.bot.session.close()
-
         # Notification stored and sent
         logger.info("Done notification for Abonement Visit!")
         return res
 
     # Table Generator results
-    def prepare_table_generator_result(self, msg: dict) -> None:
+    def prepare_table_generator_result(self, msg: dict) -> QueueJob:
         logger.info("Prepare table generator result...")
-        self.msg_text = "Получен результат генерации таблицы\n\n"
+        task_id = -1
+        msg_text = "Получен результат генерации таблицы\n\n"
         if msg.get("task_id"):
-            self.task_id = int(msg["task_id"])
-            self.msg_text += f"ID: {msg['task_id']}\n"
+            task_id = int(msg["task_id"])
+            msg_text += f"ID: {msg['task_id']}\n"
         if msg.get("table"):
             table_name = msg["table"]
             for table in tables:
                 if table["generator_name"] == table_name:
                     table_name = table["title"]
                     break
-            self.msg_text += f"Таблица: {table_name}\n"
+            msg_text += f"Таблица: {table_name}\n"
         if msg.get("result"):
             res = "Успешно" if msg["result"] == "done" else "Ошибка"
-            self.msg_text += f"Результат: {res}\n"
-        self.pending = "text"
+            msg_text += f"Результат: {res}\n"
         logger.info("Done table generator result!")
+        return QueueJob(
+            job_type=msg["job_type"], pending="text", task_id=task_id, msg_text=msg_text
+        )
 
     # Pictures Generator results
-    def prepare_pictures_generator_result(self, msg: dict) -> None:
+    def prepare_pictures_generator_result(self, msg: dict) -> QueueJob:
         logger.info("Prepare pictures generator result...")
-        self.msg_text = "Получен результат генерации обложки"
+        task_id = -1
+        msg_text = "Получен результат генерации обложки"
+        file_path = ""
+        artifact = ""
         if msg.get("task_id"):
-            self.task_id = int(msg["task_id"])
-            self.msg_text += f" (ID: {msg['task_id']})"
-        if msg.get("image"):
-            self.file_path = msg["image"]
-            self.pending = msg.get("output_type", "")
-            if not self.pending:
-                self.pending = "picture"
+            task_id = int(msg["task_id"])
+            msg_text += f" (ID: {msg['task_id']})"
+        if msg.get("artifact") or msg.get("image"):
+            artifact = msg.get("artifact", "")
+            file_path = msg.get("image", "")
+            pending = msg.get("output_type", "")
+            if not pending:
+                pending = "picture"
         else:
-            self.pending = ""
+            pending = ""
             logger.warning("Error: image not found in task result")
         logger.info("Done pictures generator result!")
+        return QueueJob(
+            job_type=msg["job_type"],
+            pending=pending,
+            task_id=task_id,
+            msg_text=msg_text,
+            file_path=file_path,
+            artifact=artifact,
+        )
 
     # Convert RabbitMQ message
-    def convert_rabbitmq_message(self, body):
+    def convert_rabbitmq_message(self, body) -> Optional[QueueJob]:
         logger.info("Convert RabbitMQ incoming message...")
         # Decode message
         try:
             msg = json.loads(body.decode())
         except Exception:
             logger.warning("Error decoding", exc_info=True)
-            return
+            return None
         # Prepare notification
-        self.task_id = -1
-        self.msg_text = ""
-        self.file_path = ""
-        self.pending = ""
         logger.info("Incoming job type: %s", msg.get("job_type"))
         if msg.get("job_type") == "table_generator":
-            self.prepare_table_generator_result(msg)
+            job = self.prepare_table_generator_result(msg)
         elif msg.get("job_type") == "pictures_generator":
-            self.prepare_pictures_generator_result(msg)
+            job = self.prepare_pictures_generator_result(msg)
         elif msg.get("job_type") == "abonement_update":
-            self.google = GoogleApi()
-            self.google.auth()
-            self.pending = "abonement_update"
-            self.abonement_id = (
-                int(msg.get("abonement_id")) if msg.get("abonement_id") else None
-            )
-            self.user_tg_id = (
-                int(msg.get("user_tg_id")) if msg.get("user_tg_id") else None
+            job = QueueJob(
+                job_type=msg["job_type"],
+                pending="abonement_update",
+                abonement_id=(
+                    int(msg.get("abonement_id")) if msg.get("abonement_id") else None
+                ),
+                user_tg_id=(
+                    int(msg.get("user_tg_id")) if msg.get("user_tg_id") else None
+                ),
             )
         elif msg.get("job_type") == "abonement_visit":
-            self.google = GoogleApi()
-            self.google.auth()
-            self.pending = "abonement_visit"
-            self.msg_type = msg.get("msg_type")
-            self.abonement_id = (
-                int(msg.get("abonement_id")) if msg.get("abonement_id") else None
-            )
-            self.visit_id = int(msg.get("visit_id")) if msg.get("visit_id") else None
-            self.visit_user_id = (
-                int(msg.get("visit_user_id")) if msg.get("visit_user_id") else None
+            job = QueueJob(
+                job_type=msg["job_type"],
+                pending="abonement_visit",
+                msg_type=msg.get("msg_type"),
+                abonement_id=(
+                    int(msg.get("abonement_id")) if msg.get("abonement_id") else None
+                ),
+                visit_id=int(msg.get("visit_id")) if msg.get("visit_id") else None,
+                visit_user_id=(
+                    int(msg.get("visit_user_id")) if msg.get("visit_user_id") else None
+                ),
+                user_id=int(msg.get("user_id")) if msg.get("user_id") else None,
+                ts=msg.get("ts"),
+                ts_new=msg.get("ts_new"),
             )
-            self.user_id = int(msg.get("user_id")) if msg.get("user_id") else None
-            self.ts = msg.get("ts")
-            self.ts_new = msg.get("ts_new")
         else:
             logger.warning("Unknown job type: %s", msg.get("job_type"))
-            return
+            return None
         logger.info("Done RabbitMQ message converting!")
+        return job
 
     # Store notification to DB and send to Telegram
-    async def create_notification(self) -> bool:
+    async def create_notification(self, job: QueueJob) -> bool:
         logger.info("Checking notification data...")
 
         # Notify about abonement update
-        if self.pending == "abonement_update":
-            need_notify = True if self.user_tg_id else False
+        if job.pending == "abonement_update":
+            need_notify = True if job.user_tg_id else False
             logger.info("Notify (%s) about abonement update...", need_notify)
-            return await self.notify_abonement_update(need_notify=need_notify)
+            return await self.notify_abonement_update(job, need_notify=need_notify)
 
         # Notify about abonement visit
-        if self.pending == "abonement_visit":
+        if job.pending == "abonement_visit":
             logger.info("Notify about abonement visit...")
-            return await self.notify_abonement_visit()
+            return await self.notify_abonement_visit(job)
 
         # Notify about task result
-        if not self.pending or not self.task_id:
+        if not job.pending or not job.task_id:
             logger.warning("Error creating notification: no pending or no task_id")
             return False
 
         # Prepare notification data
-        task_id = self.task_id
-        if self.pending == "text":
-            text = self.msg_text
-        elif self.pending == "picture":
-            text = self.msg_text
-            file_path = self.file_path
-        elif self.pending == "document":
-            text = self.msg_text
-            file_path = self.file_path
+        task_id = job.task_id
+        if job.pending in ("text", "picture", "document"):
+            text = job.msg_text
         else:
-            logger.warning("Unknown pending type: %s", self.pending)
+            logger.warning("Unknown pending type: %s", job.pending)
             return False
 
         # Process notification
@@ -435,24 +497,27 @@ class QueueHandler:
                 logger.warning(f"Task creator for task={task_id} not found")
 
             # Send Telegram message
+            await db.release()  # no connection held during Telegram API calls
             try:
                 logger.info(f"Sending message to chat {chat_id}...")
-                if self.pending == "text":
+                if job.pending == "text":
                     res = await self.sendText(chat_id, text)
-                elif self.pending == "picture":
-                    res = await self.sendPicture(chat_id, text, file_path)
-                    os.remove(file_path)
-                    logger.info("Picture %s deleted", file_path)
-                elif self.pending == "document":
-                    res = await self.sendDocument(chat_id, text, file_path)
-                    os.remove(file_path)
-                    logger.info("Document %s deleted", file_path)
+                elif job.artifact:
+                    res = await self.sendArtifact(
+                        chat_id, text, job.pending, job.artifact
+                    )
                 else:
-                    logger.warning("Unknown pending type: %s", self.pending)
+                    res = await self.sendTempFile(
+                        chat_id, text, job.pending, job.file_path
+                    )
             except Exception:
                 logger.warning(f"Error sending to {chat_id}", exc_info=True)
-            await self.bot.session.close()
 
         # Notification stored and sent
         logger.info("Done notification!")
         return res
+
+    # Flush pending spreadsheet changes and close Bot session
+    async def close(self) -> None:
+        await self.visit_sync.close()
+        await self.bot.session.close()
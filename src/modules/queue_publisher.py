@@ -1,34 +1,335 @@
+import asyncio
 import json
 import pika
 import logging
+import threading
+import uuid
+from functools import partial
+from typing import Optional
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.channel import Channel
+from pika.exceptions import AMQPError
 from utils.config import config
 
 logger = logging.getLogger(__name__)
 
+PUBLISHER = config["RABBITMQ"].get("PUBLISHER", {})
+CHANNELS = PUBLISHER.get("CHANNELS", 2)
+CONFIRM_TIMEOUT = PUBLISHER.get("CONFIRM_TIMEOUT", 5)
+RETRIES = PUBLISHER.get("RETRIES", 1)
+
+# Worker job queues by job type (jobs of unknown type go to TASKS queue)
+JOBS = config["RABBITMQ"].get("JOBS", {})
+MAX_PRIORITY = config["RABBITMQ"].get("MAX_PRIORITY", 10)
+PRIORITIES = config["RABBITMQ"].get("PRIORITIES", {})
+PRIORITY_INTERACTIVE = PRIORITIES.get("INTERACTIVE", 5)
+PRIORITY_BATCH = PRIORITIES.get("BATCH", 1)
+
+
+class PublishError(Exception):
+    pass
+
+
+# Asyncio publisher with long-lived connection and confirmed channels pool
+class AsyncPublisher:
+    def __init__(self, url: str, channels: int = 1, confirm_timeout: float = 5):
+        self.url = url
+        self.channels_count = max(1, channels)
+        self.confirm_timeout = confirm_timeout
+        self.connection: Optional[AsyncioConnection] = None
+        self.channels: list[Channel] = []
+        self.declared: set[str] = set()
+        self.tags: dict[int, int] = {}
+        self.pending: dict[int, dict[int, asyncio.Future]] = {}
+        self.next_channel = 0
+        self.lock = asyncio.Lock()
+
+    # Open connection and channels (if not opened yet)
+    async def connect(self) -> None:
+        async with self.lock:
+            if not self.connection or not self.connection.is_open:
+                await self.open_connection()
+            while len(self.channels) < self.channels_count:
+                self.channels.append(await self.open_channel())
+
+    # Open connection to RabbitMQ
+    async def open_connection(self) -> None:
+        logger.info("Publisher: opening connection...")
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+        self.channels = []
+        self.declared.clear()
+        self.connection = AsyncioConnection(
+            pika.URLParameters(self.url),
+            on_open_callback=lambda conn: set_future(opened, conn),
+            on_open_error_callback=lambda conn, err: set_future(
+                opened, exc=PublishError(f"Connection failed: {err}")
+            ),
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=loop,
+        )
+        await opened
+        logger.info("Publisher: connection opened")
+
+    # Open channel with publisher confirms
+    async def open_channel(self) -> Channel:
+        if not self.connection:
+            raise PublishError("No connection")
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+        self.connection.channel(on_open_callback=lambda ch: set_future(opened, ch))
+        channel: Channel = await opened
+        channel.add_on_close_callback(self.on_channel_closed)
+        confirmed = loop.create_future()
+        channel.confirm_delivery(
+            ack_nack_callback=partial(self.on_delivery_confirmation, channel),
+            callback=lambda frame: set_future(confirmed, frame),
+        )
+        await confirmed
+        self.tags[channel.channel_number] = 0
+        self.pending[channel.channel_number] = {}
+        logger.info("Publisher: channel %s opened", channel.channel_number)
+        return channel
+
+    # Select next channel from pool
+    def pick_channel(self) -> Channel:
+        if not self.channels:
+            raise PublishError("No open channels")
+        self.next_channel = (self.next_channel + 1) % len(self.channels)
+        return self.channels[self.next_channel]
+
+    # Declare queue once per connection
+    async def declare(self, channel: Channel, queue_name: str) -> None:
+        if queue_name in self.declared:
+            return
+        declared = asyncio.get_running_loop().create_future()
+        channel.queue_declare(
+            queue=queue_name,
+            arguments=queue_arguments(queue_name),
+            callback=lambda frame: set_future(declared, frame),
+        )
+        await declared
+        self.declared.add(queue_name)
+
+    # Publish message and wait for broker confirmation. Message is published
+    # again only after channel/connection error or Nack: on confirm timeout
+    # broker may already have it. Retries keep the same message_id.
+    async def publish(
+        self, msg: dict, queue_name: str, priority: Optional[int] = None
+    ) -> None:
+        body = json.dumps(msg)
+        properties = pika.BasicProperties(
+            message_id=str(uuid.uuid4()), priority=priority
+        )
+        for attempt in range(RETRIES + 1):
+            try:
+                await self.connect()
+                channel = self.pick_channel()
+                await self.declare(channel, queue_name)
+                await self.publish_confirmed(channel, queue_name, body, properties)
+                return
+            except asyncio.TimeoutError as e:
+                logger.warning("Publisher: confirm timeout, not published again")
+                raise PublishError(f"Not confirmed by {queue_name}") from e
+            except (AMQPError, PublishError) as e:
+                logger.warning("Publisher: attempt %s failed: %r", attempt + 1, e)
+                if attempt >= RETRIES:
+                    raise PublishError(f"Can't publish to {queue_name}") from e
+
+    # Publish message on channel and wait for Ack/Nack
+    async def publish_confirmed(
+        self,
+        channel: Channel,
+        queue_name: str,
+        body: str,
+        properties: pika.BasicProperties,
+    ) -> None:
+        number = channel.channel_number
+        confirmed = asyncio.get_running_loop().create_future()
+        self.tags[number] += 1
+        tag = self.tags[number]
+        self.pending[number][tag] = confirmed
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue_name,
+            body=body,
+            properties=properties,
+        )
+        try:
+            await asyncio.wait_for(confirmed, self.confirm_timeout)
+        finally:
+            self.pending.get(number, {}).pop(tag, None)
+
+    # Handle Ack/Nack from broker
+    def on_delivery_confirmation(self, channel: Channel, frame) -> None:
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        pending = self.pending.get(channel.channel_number, {})
+        if method.multiple:
+            tags = [tag for tag in pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            confirmed = pending.pop(tag, None)
+            if not confirmed:
+                continue
+            if acked:
+                set_future(confirmed, tag)
+            else:
+                set_future(confirmed, exc=PublishError(f"Message {tag} nacked"))
+
+    # Drop closed channel from pool
+    def on_channel_closed(self, channel: Channel, reason) -> None:
+        logger.warning("Publisher: channel %s closed: %s", channel, reason)
+        if channel in self.channels:
+            self.channels.remove(channel)
+        self.fail_pending(self.pending.pop(channel.channel_number, {}), reason)
+
+    # Drop closed connection (reconnect on next publish)
+    def on_connection_closed(self, connection, reason) -> None:
+        logger.warning("Publisher: connection closed: %s", reason)
+        self.connection = None
+        self.channels = []
+        for pending in self.pending.values():
+            self.fail_pending(pending, reason)
+        self.pending.clear()
+
+    # Fail all pending confirmations
+    def fail_pending(self, pending: dict[int, asyncio.Future], reason) -> None:
+        for confirmed in pending.values():
+            set_future(confirmed, exc=PublishError(f"Closed: {reason}"))
+        pending.clear()
+
+    # Close connection
+    async def close(self) -> None:
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+        logger.info("Publisher: connection closed")
+
+
+# Blocking publisher with long-lived connection (for sync workers,
+# shared by worker threads)
+class BlockingPublisher:
+    def __init__(self, url: str):
+        self.url = url
+        self.lock = threading.Lock()
+        self.connection: Optional[pika.BlockingConnection] = None
+        self.channel: Optional[BlockingChannel] = None
+        self.declared: set[str] = set()
+
+    # Open connection and channel with publisher confirms. Connection is idle
+    # between jobs (heartbeats are not served), so it is checked before use:
+    # pending events are processed, connection closed by broker is reopened.
+    def connect(self) -> BlockingChannel:
+        if self.connection and self.channel and self.channel.is_open:
+            try:
+                self.connection.process_data_events(time_limit=0)
+            except AMQPError as e:
+                logger.info("Publisher: idle connection lost (%r), reconnecting", e)
+            else:
+                if self.channel.is_open:
+                    return self.channel
+        self.close()
+        self.connection = pika.BlockingConnection(pika.URLParameters(self.url))
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        self.declared.clear()
+        return self.channel
+
+    # Publish message (basic_publish raises on Nack)
+    def publish(self, msg: dict, queue_name: str) -> None:
+        with self.lock:
+            self.publish_locked(msg, queue_name)
+
+    # Publish message (connection is used by one thread at a time)
+    def publish_locked(self, msg: dict, queue_name: str) -> None:
+        body = json.dumps(msg)
+        for attempt in range(RETRIES + 1):
+            try:
+                channel = self.connect()
+                if queue_name not in self.declared:
+                    channel.queue_declare(
+                        queue=queue_name, arguments=queue_arguments(queue_name)
+                    )
+                    self.declared.add(queue_name)
+                channel.basic_publish(exchange="", routing_key=queue_name, body=body)
+                return
+            except AMQPError as e:
+                logger.warning("Publisher: attempt %s failed: %r", attempt + 1, e)
+                self.channel = None
+                if attempt >= RETRIES:
+                    raise PublishError(f"Can't publish to {queue_name}") from e
+
+    # Close connection
+    def close(self) -> None:
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            logger.warning("Publisher: error closing connection", exc_info=True)
+        self.connection = None
+        self.channel = None
+
+
+# Queue for job type
+def job_queue(job_type: str) -> str:
+    return JOBS.get(job_type, {}).get("QUEUE") or config["RABBITMQ"]["QUEUES"]["TASKS"]
+
+
+# Arguments of queue declaration (job queues support message priorities)
+def queue_arguments(queue_name: str) -> Optional[dict]:
+    if any(job.get("QUEUE") == queue_name for job in JOBS.values()):
+        return {"x-max-priority": MAX_PRIORITY}
+    return None
+
+
+# Set future result or exception (if not done yet)
+def set_future(
+    future: asyncio.Future, result=None, exc: Optional[Exception] = None
+) -> None:
+    if future.done():
+        return
+    if exc:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+publisher = AsyncPublisher(
+    config["RABBITMQ"]["URL"], channels=CHANNELS, confirm_timeout=CONFIRM_TIMEOUT
+)
+blocking_publisher = BlockingPublisher(config["RABBITMQ"]["URL"])
+
 
 # Publish message to RabbitMQ
-def publish(msg: dict, queue_name: str) -> None:
-    message_json = json.dumps(msg)
-    connection = pika.BlockingConnection(pika.ConnectionParameters("localhost"))
-    channel = connection.channel()
-    channel.queue_declare(queue=config["RABBITMQ"]["QUEUES"][queue_name])
-    channel.basic_publish(
-        exchange="",
-        routing_key=config["RABBITMQ"]["QUEUES"][queue_name],
-        body=message_json,
-    )
-    connection.close()
+async def publish(msg: dict, queue_name: str) -> None:
+    await publisher.publish(msg, config["RABBITMQ"]["QUEUES"][queue_name])
 
 
 # Publish RESULT to RabbitMQ
-def result(msg: dict) -> None:
+async def result(msg: dict) -> None:
     logger.info("Publishing result to queue...")
-    publish(msg, "RESULTS")
+    await publish(msg, "RESULTS")
     logger.info("Done publishing result to queue!")
 
 
-# Publish TASK to RabbitMQ
-def task(msg: dict) -> None:
-    logger.info("Publishing task to queue...")
-    publish(msg, "TASKS")
+# Publish TASK to RabbitMQ (to queue of job type). Batch jobs are published
+# with PRIORITY_BATCH: worker takes interactive jobs of the same type first.
+async def task(msg: dict, priority: int = PRIORITY_INTERACTIVE) -> None:
+    queue_name = job_queue(msg.get("job_type", "no_job_type"))
+    logger.info("Publishing task to queue %s (priority %s)...", queue_name, priority)
+    await publisher.publish(msg, queue_name, priority)
     logger.info("Done publishing task to queue!")
+
+
+# Close publisher connection
+async def close() -> None:
+    await publisher.close()
+
+
+# Publish RESULT to RabbitMQ (from sync worker)
+def result_blocking(msg: dict) -> None:
+    logger.info("Publishing result to queue...")
+    blocking_publisher.publish(msg, config["RABBITMQ"]["QUEUES"]["RESULTS"])
+    logger.info("Done publishing result to queue!")
@@ -1,30 +1,36 @@
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from modules import queue_publisher
 from utils.config import config, tables
 from utils.google_api import GoogleApi
-from utils.ftp import Ftp
+from utils.ftp import Ftp, FtpPool
+from storage.table_manifest import TableManifest, params_hash
 
 logger = logging.getLogger(__name__)
 
+TABLE_CONVERTER = config["TABLE_CONVERTER"]
+
 
 class TableCreator:
     def __init__(self):
-        pass
+        self.workers = TABLE_CONVERTER.get("WORKERS", 4)
+        self.ftp_connections = TABLE_CONVERTER.get("FTP_CONNECTIONS", 2)
+        self.manifest = TableManifest(
+            TABLE_CONVERTER.get("MANIFEST")
+            or self.get_output_file_path("tables_manifest.json")
+        )
 
     # Get output file path
     def get_output_file_path(self, file_name: str) -> str:
         return os.path.join(config["TABLE_CONVERTER"]["OUTPUT_DIR"], file_name)
 
-    # Convert one table from Google Spreadsheet to JavaScript (JSON)
-    def convert_table(self, google: GoogleApi, table_params: dict) -> None:
+    # Read and parse one table from Google Spreadsheet (ID is set before)
+    def read_table(self, google: GoogleApi, table_params: dict) -> None:
         logger.info(f"Table name: {table_params['generator_name']}")
-        output_file = self.get_output_file_path(table_params["output_file"])
-        google.setSpreadsheetId(table_params["spreadsheetId"])
         google.setSpreadsheetRange(table_params["range"])
         google.readSpreadsheet()
         google.parseSpreadsheet(table_params["fields"])
-        google.saveSpreadsheetToJs(output_file)
         logger.info(f"Done table: {table_params['generator_name']}")
 
     # Upload generated JavaScript file to FTP
@@ -33,28 +39,72 @@ class TableCreator:
         uploader.upload(table_params, local_dir=config["TABLE_CONVERTER"]["OUTPUT_DIR"])
         logger.info(f"Uploaded file: {table_params['output_file']}")
 
-    # Handle new task from RabbitMQ
+    # Convert and upload one table (in pool thread). Spreadsheet is not read
+    # if it was not modified, file is not uploaded if data was not changed.
+    def process_table(self, uploaders: FtpPool, table_params: dict) -> None:
+        name = table_params["generator_name"]
+        logger.info(f"Processing table {name}...")
+        google = GoogleApi()  # Google services are per thread
+        google.auth()
+        google.setSpreadsheetId(table_params["spreadsheetId"])
+        modified = google.readMetadata()
+        output_file = self.get_output_file_path(table_params["output_file"])
+        entry = self.manifest.get(name) or {}
+        params = params_hash(table_params)
+        generated = entry.get("params") == params and os.path.exists(output_file)
+        if generated and entry.get("modified") == modified:
+            logger.info(f"Table {name} not modified since {modified}, skipped")
+            return
+        self.read_table(google, table_params)
+        data_hash = google.dataHash()
+        if generated and entry.get("hash") == data_hash:
+            logger.info(f"Table {name} data not changed, upload skipped")
+        else:
+            google.saveSpreadsheetToJs(
+                output_file, columnar=table_params.get("columnar", False)
+            )
+            with uploaders.connection() as uploader:
+                self.upload_table(uploader, table_params)
+        self.manifest.set(
+            name, {"params": params, "modified": modified, "hash": data_hash}
+        )
+
+    # Handle new task from RabbitMQ: tables are processed in parallel,
+    # result of each table is published as soon as it is done
     def handle_new_task(self, msg: dict) -> None:
-        # Prepare converter and uploader
         msg_job = msg.get("job", "no_job")
         logger.info(f"Prepare job '{msg_job}'...")
-        google = GoogleApi()
-        uploader = Ftp()
-        google.auth()
-        uploader.start()
+        selected_tables = []
         for table_params in tables:
-            # Convert and upload one table
             if msg_job not in [table_params.get("generator_name"), "all"]:
                 logger.info(f"Skipping table {table_params['generator_name']}")
                 continue
-            logger.info(f"Processing table {table_params['generator_name']}...")
-            self.convert_table(google, table_params)
-            self.upload_table(uploader, table_params)
-            # Publish result
-            msg["uuid"] = msg.get("uuid", "no_uuid")
-            msg["table"] = table_params["generator_name"]
-            msg["result"] = "done"
-            queue_publisher.result(msg)
-            logger.info(f"Done table {table_params['generator_name']}!")
-        uploader.quit()
+            selected_tables.append(table_params)
+        uploaders = FtpPool(self.ftp_connections)
+        with ThreadPoolExecutor(
+            max_workers=max(1, self.workers), thread_name_prefix="table"
+        ) as executor:
+            futures = {
+                executor.submit(self.process_table, uploaders, table_params): (
+                    table_params
+                )
+                for table_params in selected_tables
+            }
+            for future in as_completed(futures):
+                table_params = futures[future]
+                try:
+                    future.result()
+                    result = "done"
+                    logger.info(f"Done table {table_params['generator_name']}!")
+                except Exception:
+                    result = "error"
+                    logger.error(
+                        f"Table {table_params['generator_name']} failed", exc_info=True
+                    )
+                # Publish result (from this thread: publisher is not thread-safe)
+                msg["uuid"] = msg.get("uuid", "no_uuid")
+                msg["table"] = table_params["generator_name"]
+                msg["result"] = result
+                queue_publisher.result_blocking(msg)
+        uploaders.quit()
         logger.info("Done converting!")
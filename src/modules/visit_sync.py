@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from utils.google_api import GoogleApi, VisitChange
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind sync of Visit changes to Abonement spreadsheets. Changes
+# that failed to flush go back to buffer and are retried with backoff.
+class VisitSync:
+    def __init__(self, delay: float, max_delay: float = 300):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.buffers: dict[str, dict[int, VisitChange]] = {}
+        self.flushers: dict[str, asyncio.Task] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.failures: dict[str, int] = {}
+        self.closing = False
+
+    # Add Visit change to buffer (flushed after delay)
+    def add(self, spreadsheet_id: str, change: VisitChange) -> None:
+        buffer = self.buffers.setdefault(spreadsheet_id, {})
+        if change.visit_id in buffer:
+            buffer[change.visit_id].merge(change)
+        else:
+            buffer[change.visit_id] = change
+        logger.info("Visit %s buffered for %s", change.visit_id, spreadsheet_id)
+        self.schedule(spreadsheet_id, self.delay)
+
+    # Flush buffer after delay (if flush is not scheduled yet)
+    def schedule(self, spreadsheet_id: str, delay: float) -> None:
+        if spreadsheet_id not in self.flushers:
+            self.flushers[spreadsheet_id] = asyncio.get_running_loop().create_task(
+                self.flush_later(spreadsheet_id, delay)
+            )
+
+    # Return failed changes to buffer (changes added meanwhile are newer)
+    def restore(self, spreadsheet_id: str, changes: dict[int, VisitChange]) -> None:
+        for visit_id, change in self.buffers.get(spreadsheet_id, {}).items():
+            if visit_id in changes:
+                changes[visit_id].merge(change)
+            else:
+                changes[visit_id] = change
+        self.buffers[spreadsheet_id] = changes
+
+    # Exclusive access to spreadsheet
+    @asynccontextmanager
+    async def lock(self, spreadsheet_id: str) -> AsyncIterator[None]:
+        async with self.locks.setdefault(spreadsheet_id, asyncio.Lock()):
+            yield
+
+    async def flush_later(self, spreadsheet_id: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush(spreadsheet_id)
+
+    # Send buffered changes with one batchUpdate
+    async def flush(self, spreadsheet_id: str) -> None:
+        async with self.lock(spreadsheet_id):
+            flusher = self.flushers.pop(spreadsheet_id, None)
+            if flusher and flusher is not asyncio.current_task():
+                flusher.cancel()
+            changes = self.buffers.pop(spreadsheet_id, {})
+            if not changes:
+                return
+            logger.info("Flush %d Visit(s) to %s", len(changes), spreadsheet_id)
+            try:
+                await asyncio.to_thread(
+                    self.apply, spreadsheet_id, list(changes.values())
+                )
+                self.failures.pop(spreadsheet_id, None)
+            except Exception:
+                self.restore(spreadsheet_id, changes)
+                if self.closing:
+                    logger.error(
+                        "Error flushing to %s, %d Visit change(s) not saved",
+                        spreadsheet_id,
+                        len(self.buffers[spreadsheet_id]),
+                        exc_info=True,
+                    )
+                    return
+                failures = self.failures.get(spreadsheet_id, 0) + 1
+                self.failures[spreadsheet_id] = failures
+                delay = min(self.delay * 2**failures, self.max_delay)
+                logger.error(
+                    "Error flushing to %s, retry in %s s",
+                    spreadsheet_id,
+                    delay,
+                    exc_info=True,
+                )
+                self.schedule(spreadsheet_id, delay)
+
+    # Apply changes to spreadsheet (all Google API calls in one thread)
+    @staticmethod
+    def apply(spreadsheet_id: str, changes: list[VisitChange]) -> None:
+        google = GoogleApi()
+        google.auth()
+        google.setSpreadsheetId(spreadsheet_id)
+        google.visitsApply(changes)
+
+    # Flush all buffers (on shutdown, failed changes are not retried)
+    async def close(self) -> None:
+        self.closing = True
+        for spreadsheet_id in list(self.buffers):
+            await self.flush(spreadsheet_id)
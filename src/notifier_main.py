@@ -1,10 +1,11 @@
 import sentry_sdk
 import asyncio
 import os
+import signal
 from sqlalchemy import URL
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from utils.config import config
-from storage.db_schema import Base
+from storage.db_migrate import migrate
 from modules.queue_consumer import QueueConsumer
 from utils.log import setup_logger
 
@@ -26,7 +27,16 @@ url: URL = URL.create(
     host=config["DB"]["HOST"],
     database=config["DB"]["NAME"],
 )
-engine = create_async_engine(url, echo=False)
+POOL = config["DB"].get("POOL", {})
+engine = create_async_engine(
+    url,
+    echo=False,
+    pool_size=POOL.get("SIZE", 5),
+    max_overflow=POOL.get("MAX_OVERFLOW", 10),
+    pool_timeout=POOL.get("TIMEOUT", 30),
+    pool_recycle=POOL.get("RECYCLE", 1800),
+    pool_pre_ping=POOL.get("PRE_PING", False),
+)
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 
 
@@ -36,7 +46,7 @@ async def main():
 
     # Initialize DB
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await migrate(conn, config["DB"].get("PARTITIONS", {}).get("MONTHS_AHEAD", 1))
 
     # Setup RabbitMQ consumer
     logger.info("Starting RabbitMQ consumer...")
@@ -46,11 +56,16 @@ async def main():
         bot_token=config["BOT"]["TOKEN"],
         admin_id=config["BOT"]["ADMIN"],
         session_maker=AsyncSessionLocal,
+        concurrency=config["RABBITMQ"].get("CONSUMER", {}).get("CONCURRENCY", 1),
     )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, consumer.shutdown)
     logger.info("Worker started, waiting for messages...")
     await consumer.start()
 
-    # Exit
+    # Exit (pending Visit changes are flushed before connection is closed)
+    await consumer.close()
     consumer.stop()
     logger.info("Finished queue notifier!")
 
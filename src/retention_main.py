@@ -0,0 +1,69 @@
+import sentry_sdk
+import asyncio
+import os
+from sqlalchemy import URL
+from sqlalchemy.ext.asyncio import create_async_engine
+from utils.config import config
+from storage.db_partitions import (
+    TABLES,
+    default_partition_split,
+    legacy_table_copy,
+    partitions_archive,
+    partitions_create,
+)
+from utils.log import setup_logger
+
+# Setup Sentry
+sentry_sdk.init(config["SENTRY"]["DSN"])
+
+# Setup logging
+logger = setup_logger(
+    name=__name__,
+    file=config["LOG"]["RETENTION"]["FILE"],
+    level=config["LOG"]["RETENTION"]["LEVEL"],
+)
+
+# Setup DB
+url: URL = URL.create(
+    config["DB"]["TYPE"],
+    username=config["DB"]["USERNAME"],
+    password=config["DB"]["PASSWORD"],
+    host=config["DB"]["HOST"],
+    database=config["DB"]["NAME"],
+)
+engine = create_async_engine(url, echo=False)
+PARTITIONS = config["DB"].get("PARTITIONS", {})
+
+
+# MAIN (run daily: move rows of legacy tables, create next partitions,
+# archive and drop old partitions)
+async def main():
+    logger.info(f"Starting log retention with PID={os.getpid()}...")
+
+    # Move rows of tables created before partitioning
+    for table in TABLES:
+        await legacy_table_copy(engine, table, PARTITIONS.get("COPY_BATCH", 10000))
+
+    # Create partitions in advance, move DEFAULT partition rows to months
+    async with engine.begin() as conn:
+        await partitions_create(conn, PARTITIONS.get("MONTHS_AHEAD", 1))
+        for table in TABLES:
+            await default_partition_split(conn, table)
+
+    # Archive old partitions
+    async with engine.connect() as conn:
+        archived = await partitions_archive(
+            conn,
+            PARTITIONS.get("KEEP_MONTHS", 6),
+            PARTITIONS.get("ARCHIVE_DIR", "archive"),
+        )
+    logger.info("Archived %d partition(s)", len(archived))
+
+    # Exit
+    await engine.dispose()
+    logger.info("Finished log retention!")
+
+
+# Entry point
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS = config.get("ARTIFACTS", {})
+
+
+# Content-addressed store of generated files in local directory shared by
+# worker and notifier. File name is hash of content, files are written once
+# by rename and never changed (safe to read or mmap while in use). Files not
+# used for TTL seconds are evicted. Next to artifact are kept:
+#   <key>.key - artifact name for render key (task parameters hash)
+#   <name>.<kind>.file_id - Telegram file_id of uploaded artifact
+class ArtifactStore:
+    def __init__(
+        self, directory: str, ttl: float = 86400, evict_interval: float = 3600
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.evicted_at = 0.0
+
+    # Path of file in store
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, os.path.basename(name))
+
+    # Write file atomically (temporary file in the same directory, then rename)
+    def write(self, name: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.path(name))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    # Read small text file, None if missing. File is touched (used now).
+    def read_text(self, name: str) -> Optional[str]:
+        path = self.path(name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read().strip()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return text or None
+
+    # Store content, returns artifact name
+    def put(self, data: bytes, suffix: str = "") -> str:
+        name = hashlib.sha256(data).hexdigest() + suffix
+        if self.get_path(name):
+            logger.info("Artifact %s already stored", name)
+        else:
+            self.write(name, data)
+            logger.info("Artifact %s stored (%d bytes)", name, len(data))
+        return name
+
+    # Path of stored artifact, None if missing. Artifact is touched (used now).
+    def get_path(self, name: str) -> Optional[str]:
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Link render key to artifact
+    def link(self, key: str, name: str) -> None:
+        self.write(f"{key}.key", name.encode())
+
+    # Artifact linked to render key, None if key or artifact is missing
+    def resolve(self, key: str) -> Optional[str]:
+        name = self.read_text(f"{key}.key")
+        if name and self.get_path(name):
+            return name
+        return None
+
+    # Telegram file_id of artifact uploaded as kind (picture, document)
+    def file_id(self, name: str, kind: str) -> Optional[str]:
+        return self.read_text(f"{name}.{kind}.file_id")
+
+    # Store Telegram file_id of uploaded artifact
+    def set_file_id(self, name: str, kind: str, file_id: str) -> None:
+        self.write(f"{name}.{kind}.file_id", file_id.encode())
+
+    # Remove files not used for TTL seconds (at most once per evict interval)
+    def evict(self) -> int:
+        now = time.time()
+        if now - self.evicted_at < self.evict_interval:
+            return 0
+        self.evicted_at = now
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue  # removed by another process
+        if removed:
+            logger.info("Evicted %d files from %s", removed, self.directory)
+        return removed
+
+
+# Render key: hash of parameters that define generated content
+def render_key(*params) -> str:
+    content = json.dumps(params, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+artifact_store = ArtifactStore(
+    ARTIFACTS.get("DIR", "artifacts"),
+    ttl=ARTIFACTS.get("TTL", 86400),
+    evict_interval=ARTIFACTS.get("EVICT_INTERVAL", 3600),
+)
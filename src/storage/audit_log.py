@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Optional
+from aiogram.types import TelegramObject, Message
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from storage.db_schema import TgUpdate, TgMessage
+
+logger = logging.getLogger(__name__)
+
+Record = tuple[str, datetime, TelegramObject]  # (table, ts, event)
+
+
+# Write-behind log of all updates and messages (multi-row INSERTs by batches)
+class AuditLog:
+    def __init__(
+        self,
+        session: async_sessionmaker[AsyncSession],
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        queue_size: int = 10000,
+    ):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue[Optional[Record]] = asyncio.Queue(queue_size)
+        self.writer: Optional[asyncio.Task] = None
+
+    # Start writer task
+    async def start(self) -> None:
+        if not self.writer:
+            self.writer = asyncio.get_running_loop().create_task(self.write_loop())
+
+    # Add update (waits if queue is full)
+    async def add_update(self, event: TelegramObject) -> None:
+        await self.queue.put(("update", datetime.now(), event))
+
+    # Add message (waits if queue is full)
+    async def add_message(self, message: Message) -> None:
+        await self.queue.put(("message", datetime.now(), message))
+
+    # Collect records by batches (size or time limited) until stopped
+    async def write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            record = await self.queue.get()
+            if not record:
+                return
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = await asyncio.wait_for(
+                        self.queue.get(), deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if not record:
+                    stopped = True
+                    break
+                batch.append(record)
+            await self.write(batch)
+
+    # Write batch with one INSERT per table
+    async def write(self, batch: list[Record]) -> None:
+        if not batch:
+            return
+        updates: list[dict[str, Any]] = []
+        messages: list[dict[str, Any]] = []
+        for table, ts, event in batch:
+            # Bad record is skipped (writer task must not stop)
+            try:
+                if table == "message" and isinstance(event, Message):
+                    messages.append(message_row(ts, event))
+                else:
+                    updates.append(update_row(ts, event))
+            except Exception:
+                logger.error("Audit log: can't serialize %s", table, exc_info=True)
+        try:
+            async with self.session() as session:
+                if updates:
+                    await session.execute(insert(TgUpdate).values(updates))
+                if messages:
+                    await session.execute(insert(TgMessage).values(messages))
+                await session.commit()
+            logger.info(
+                "Audit log: %d update(s), %d message(s)", len(updates), len(messages)
+            )
+        except Exception:
+            logger.error(
+                "Audit log: can't write %d record(s)", len(batch), exc_info=True
+            )
+
+    # Write all queued records and stop writer
+    async def close(self) -> None:
+        if not self.writer:
+            return
+        await self.queue.put(None)
+        await self.writer
+        self.writer = None
+
+
+# Row for tg_all_updates
+def update_row(ts: datetime, event: TelegramObject) -> dict[str, Any]:
+    return {
+        "ts": ts,
+        "tg_update": event.model_dump(
+            mode="json", exclude_unset=True, exclude_none=True, exclude_defaults=True
+        ),
+    }
+
+
+# Row for tg_all_messages
+def message_row(ts: datetime, message: Message) -> dict[str, Any]:
+    user = message.from_user
+    return {
+        "ts": ts,
+        "tg_id": user.id if user and user.id else None,
+        "tg_name": user.full_name if user and user.full_name else None,
+        "tg_message": message.text if message.text else None,
+    }
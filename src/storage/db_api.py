@@ -1,46 +1,99 @@
 import logging
 import uuid
 from datetime import datetime, timedelta
-from typing import Optional, Sequence, Union
-from aiogram.types import TelegramObject, User, Message
-from storage.db_schema import TgUpdate, TgMessage, TgUser, TgNotification, TgTask
+from functools import partial
+from typing import AsyncIterator, Callable, Optional, Sequence, Tuple, Union
+from aiogram.types import TelegramObject, User
+from storage.db_schema import TgUser, TgNotification, TgTask
 from storage.db_schema import TgAbonement, TgAbonementUser, TgAbonementVisit
 from storage.db_schema import TgInvite, TgInviteUser
 from storage.db_schema import TgSettings
-from sqlalchemy import select, delete, not_
+from storage.user_cache import user_cache
+from sqlalchemy import select, insert, update, delete, literal
+from sqlalchemy import and_, or_, not_, tuple_, case
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import func
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 logger = logging.getLogger(__name__)
 
 
 class Database:
-    # Init class with session
-    def __init__(self, session: AsyncSession):
-        self.session = session
-
-    # Store event
-    async def event_to_log(self, event: TelegramObject) -> None:
-        record = TgUpdate(
-            tg_update=event.model_dump_json(
-                exclude_unset=True, exclude_none=True, exclude_defaults=True
-            )
+    # Init class with session or session maker (session is opened on first query).
+    # Unit of work: write methods only flush changes, they are committed once
+    # by commit() (DatabaseMiddleware calls it after handler).
+    def __init__(
+        self,
+        session: Union[AsyncSession, async_sessionmaker[AsyncSession]],
+        unit_of_work: bool = False,
+    ):
+        if isinstance(session, AsyncSession):
+            self.opened_session: Optional[AsyncSession] = session
+            self.session_maker = None
+        else:
+            self.opened_session = None
+            self.session_maker = session
+        self.unit_of_work = unit_of_work
+        self.flushed = False
+        self.commit_callbacks: list[Callable[[], None]] = []
+
+    # Session (opened on first access, connection is taken on first query)
+    @property
+    def session(self) -> AsyncSession:
+        if self.opened_session is None:
+            assert self.session_maker is not None
+            self.opened_session = self.session_maker()
+        return self.opened_session
+
+    # Check if session has changes not committed
+    def has_changes(self) -> bool:
+        session = self.opened_session
+        return self.flushed or bool(
+            session and (session.new or session.dirty or session.deleted)
         )
-        self.session.add(record)
-        await self.session.commit()
-
-    # Store message
-    async def message_to_log(self, message: Message) -> None:
-        record = TgMessage()
-        if message and message.from_user and message.from_user.id:
-            record.tg_id = message.from_user.id
-        if message and message.from_user and message.from_user.full_name:
-            record.tg_name = message.from_user.full_name
-        if message and message.text:
-            record.tg_message = message.text
-        self.session.add(record)
-        await self.session.commit()
+
+    # Save changes of write method: commit (or flush in unit of work)
+    async def save(self) -> None:
+        if not self.unit_of_work:
+            await self.session.commit()
+            return
+        await self.session.flush()
+        self.flushed = True
+
+    # Commit unit of work (early commit: before other processes read changes)
+    async def commit(self) -> None:
+        session = self.opened_session
+        if session is not None and session.in_transaction():
+            await session.commit()
+        self.flushed = False
+        callbacks, self.commit_callbacks = self.commit_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    # Run callback when changes are committed (now if nothing to commit)
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        if self.has_changes():
+            self.commit_callbacks.append(callback)
+        else:
+            callback()
+
+    # Return connection to pool if transaction has no pending changes
+    # (loaded objects stay in session and can be changed later). Connection
+    # is held until commit, so call it before long external I/O (in bot it is
+    # called before each Telegram API request, see ReleaseDatabaseMiddleware).
+    async def release(self) -> None:
+        session = self.opened_session
+        if not session or not session.in_transaction() or self.has_changes():
+            return
+        await session.commit()
+
+    # Close session if it was opened (changes not committed are rolled back)
+    async def close(self) -> None:
+        if self.opened_session is not None:
+            await self.opened_session.close()
+            self.opened_session = None
+        self.flushed = False
+        self.commit_callbacks = []
 
     # Add user
     async def user_add(self, tg_user: User) -> TgUser:
@@ -59,7 +112,7 @@ class Database:
                 status="unregistered",
             )
             self.session.add(user)
-            await self.session.commit()
+            await self.save()
         return user
 
     # Update user
@@ -72,7 +125,8 @@ class Database:
             return None
         logger.info(f"Update user {user.id}")
         db_user = user
-        await self.session.commit()
+        await self.save()
+        self.after_commit(partial(user_cache.invalidate, db_user.tg_id))
         return db_user
 
     # Get user by id
@@ -121,12 +175,13 @@ class Database:
         elif "unregistered" in groups and group == "registered":
             groups.remove("unregistered")
         user.status = " ".join(groups)
+        user_cache.invalidate(user.tg_id)
 
     # Create task
     async def task_add(self, task_uuid: str, user: TgUser) -> TgTask:
         task = TgTask(uuid=task_uuid, user=user)
         self.session.add(task)
-        await self.session.commit()
+        await self.save()
         return task
 
     # Get task creator
@@ -145,9 +200,19 @@ class Database:
     async def notification_add(self, user: TgUser, message: str) -> None:
         sent_message = TgNotification(user=user, message=message)
         self.session.add(sent_message)
-        await self.session.commit()
+        await self.save()
         logger.info("Notification was stored")
 
+    # Store notifications (one commit)
+    async def notifications_add(self, messages: list[Tuple[TgUser, str]]) -> None:
+        if not messages:
+            return
+        self.session.add_all(
+            [TgNotification(user=user, message=message) for user, message in messages]
+        )
+        await self.save()
+        logger.info("%s notification(s) stored", len(messages))
+
     # Abonements list for owner
     async def abonements_list_by_owner(self, user: TgUser) -> Sequence[TgAbonement]:
         stmt = select(TgAbonement).where(
@@ -188,7 +253,7 @@ class Database:
             owner=owner,
         )
         self.session.add(abonement)
-        await self.session.commit()
+        await self.save()
         return abonement
 
     # Abonement edit
@@ -208,7 +273,7 @@ class Database:
         abonement.total_visits = total_visits
         abonement.expiry_date = expiry_date
         abonement.description = description
-        await self.session.commit()
+        await self.save()
         return abonement
 
     # Abonement add/edit SpreadSheet ID
@@ -219,7 +284,7 @@ class Database:
         if not abonement:
             return None
         abonement.spreadsheet_id = spreadsheet_id
-        await self.session.commit()
+        await self.save()
         return abonement
 
     # Abonement delete
@@ -238,7 +303,7 @@ class Database:
         else:
             abonement.hidden = True  # not "await self.session.delete(abonement)"
         # Save changes
-        await self.session.commit()
+        await self.save()
         return True
 
     # Abonement by token
@@ -262,6 +327,37 @@ class Database:
         abonement_users = result.scalars().all()
         return abonement_users
 
+    # Abonement with visits count, owner and users with notification setting
+    async def abonement_notify_info(
+        self, abonement_id: int, setting_key: str
+    ) -> Optional[Tuple[TgAbonement, int, list[Tuple[TgUser, Optional[str]]]]]:
+        abonement = await self.abonement_by_id(abonement_id)
+        if not abonement:
+            return None
+        stmt_users = (
+            select(TgUser, TgSettings.value)
+            .outerjoin(
+                TgSettings,
+                and_(TgSettings.user_id == TgUser.id, TgSettings.key == setting_key),
+            )
+            .where(
+                or_(
+                    TgUser.id == abonement.owner_id,
+                    TgUser.id.in_(
+                        select(TgAbonementUser.user_id).where(
+                            TgAbonementUser.abonement_id == abonement_id
+                        )
+                    ),
+                )
+            )
+            .order_by(TgUser.id != abonement.owner_id, TgUser.id)  # owner first
+        )
+        result = await self.session.execute(stmt_users)
+        users: dict[int, Tuple[TgUser, Optional[str]]] = {}
+        for user, value in result.tuples():
+            users.setdefault(user.id, (user, value))
+        return abonement, abonement.visits_count, list(users.values())
+
     # Abonement add user
     async def abonement_user_add(
         self, user_id: int, abonement_id: int, abonement_token: str
@@ -270,9 +366,13 @@ class Database:
         abonement = await self.abonement_by_id(abonement_id)
         if not user or not abonement or abonement.token != abonement_token:
             return None
-        abonement_user = TgAbonementUser(abonement=abonement, user=user)
+        # Visits made before (if user was unlinked from Abonement)
+        visits_count = await self.abonement_visits_recount_user(abonement_id, user_id)
+        abonement_user = TgAbonementUser(
+            abonement=abonement, user=user, visits_count=visits_count
+        )
         self.session.add(abonement_user)
-        await self.session.commit()
+        await self.save()
         return abonement_user
 
     # Abonement user
@@ -287,71 +387,243 @@ class Database:
         abonement_user = result.scalars().first()
         return abonement_user
 
-    # Abonement visit count
+    # Abonement visit count (from counters: owner is not linked to Abonement
+    # as user, owner visits are counted in Abonement)
     async def abonement_visits_count(
         self, abonement_id: int, user_id: Optional[int] = None
     ) -> int:
         if not user_id:
-            stmt = (
-                func.count()
-                .select()
-                .where(TgAbonementVisit.abonement_id == abonement_id)
+            stmt = select(TgAbonement.visits_count).where(
+                TgAbonement.id == abonement_id
             )
         else:
             stmt = (
-                func.count()
-                .select()
-                .where(
-                    TgAbonementVisit.abonement_id == abonement_id,
-                    TgAbonementVisit.user_id == user_id,
+                select(
+                    case(
+                        (
+                            TgAbonement.owner_id == user_id,
+                            TgAbonement.owner_visits_count,
+                        ),
+                        else_=TgAbonementUser.visits_count,
+                    )
                 )
+                .select_from(TgAbonement)
+                .outerjoin(
+                    TgAbonementUser,
+                    and_(
+                        TgAbonementUser.abonement_id == TgAbonement.id,
+                        TgAbonementUser.user_id == user_id,
+                    ),
+                )
+                .where(TgAbonement.id == abonement_id)
             )
         result = await self.session.execute(stmt)
-        abonement_visits = result.scalar() or 0
-        return abonement_visits
+        abonement_visits = result.scalars().first()
+        return abonement_visits or 0
 
-    # Abonement visit list
-    async def abonement_visits_list(
-        self, abonement_id: int, limit: int = 1000, offset: int = 0, desc: bool = True
-    ) -> Sequence[TgAbonementVisit]:
+    # Abonement visit count for user (from visits)
+    async def abonement_visits_recount_user(
+        self, abonement_id: int, user_id: int
+    ) -> int:
+        stmt = (
+            func.count()
+            .select()
+            .where(
+                TgAbonementVisit.abonement_id == abonement_id,
+                TgAbonementVisit.user_id == user_id,
+            )
+        )
+        result = await self.session.execute(stmt)
+        return result.scalar() or 0
+
+    # Abonement visit counters repair (all Abonements if no ID given)
+    async def abonement_visits_recount(self, abonement_id: Optional[int] = None) -> int:
+        abonement_visits = (
+            select(func.count(TgAbonementVisit.id))
+            .where(TgAbonementVisit.abonement_id == TgAbonement.id)
+            .scalar_subquery()
+        )
+        user_visits = (
+            select(func.count(TgAbonementVisit.id))
+            .where(
+                TgAbonementVisit.abonement_id == TgAbonementUser.abonement_id,
+                TgAbonementVisit.user_id == TgAbonementUser.user_id,
+            )
+            .scalar_subquery()
+        )
+        owner_visits = (
+            select(func.count(TgAbonementVisit.id))
+            .where(
+                TgAbonementVisit.abonement_id == TgAbonement.id,
+                TgAbonementVisit.user_id == TgAbonement.owner_id,
+            )
+            .scalar_subquery()
+        )
+        stmt_abonements = update(TgAbonement).values(
+            visits_count=abonement_visits, owner_visits_count=owner_visits
+        )
+        stmt_users = update(TgAbonementUser).values(visits_count=user_visits)
+        if abonement_id:
+            stmt_abonements = stmt_abonements.where(TgAbonement.id == abonement_id)
+            stmt_users = stmt_users.where(TgAbonementUser.abonement_id == abonement_id)
+        options = {"synchronize_session": False}
+        result = await self.session.execute(stmt_abonements, execution_options=options)
+        await self.session.execute(stmt_users, execution_options=options)
+        await self.save()
+        return result.rowcount
+
+    # Abonement visit counters change (in current transaction)
+    async def abonement_visits_count_add(
+        self, abonement_id: int, user_id: int, delta: int
+    ) -> None:
+        await self.session.execute(
+            update(TgAbonement)
+            .where(TgAbonement.id == abonement_id)
+            .values(
+                visits_count=TgAbonement.visits_count + delta,
+                owner_visits_count=TgAbonement.owner_visits_count
+                + case((TgAbonement.owner_id == user_id, delta), else_=0),
+            )
+        )
+        await self.session.execute(
+            update(TgAbonementUser)
+            .where(
+                TgAbonementUser.abonement_id == abonement_id,
+                TgAbonementUser.user_id == user_id,
+            )
+            .values(visits_count=TgAbonementUser.visits_count + delta)
+        )
+
+    # Abonement visit page, newest first (keyset pagination by ts and id).
+    # Cursor is (ts, id) of Visit, which may be deleted already. Direction
+    # from cursor: "next" - older, "prev" - newer, "page" - the cursor and
+    # older. Also returns if there are more visits in this direction.
+    async def abonement_visits_page(
+        self,
+        abonement_id: int,
+        limit: int,
+        cursor: Optional[Tuple[datetime, int]] = None,
+        direction: str = "next",
+    ) -> Tuple[list[TgAbonementVisit], bool]:
+        key = tuple_(TgAbonementVisit.ts, TgAbonementVisit.id)
         stmt = (
             select(TgAbonementVisit)
             .options(joinedload(TgAbonementVisit.user))
             .where(TgAbonementVisit.abonement_id == abonement_id)
-            .order_by(TgAbonementVisit.ts.desc() if desc else TgAbonementVisit.ts.asc())
-            .limit(limit)
-            .offset(offset)
+            .limit(limit + 1)
         )
+        if direction == "prev":
+            stmt = stmt.order_by(TgAbonementVisit.ts, TgAbonementVisit.id)
+        else:
+            stmt = stmt.order_by(TgAbonementVisit.ts.desc(), TgAbonementVisit.id.desc())
+        if cursor:
+            start_key = tuple_(*cursor)
+            if direction == "prev":
+                stmt = stmt.where(key > start_key)
+            elif direction == "page":
+                stmt = stmt.where(key <= start_key)
+            else:
+                stmt = stmt.where(key < start_key)
         result = await self.session.execute(stmt)
-        abonement_visits = result.scalars().all()
-        return abonement_visits
+        abonement_visits = list(result.scalars().all())
+        has_more = len(abonement_visits) > limit
+        abonement_visits = abonement_visits[:limit]
+        if direction == "prev":
+            abonement_visits.reverse()
+        return abonement_visits, has_more
+
+    # Abonement visits with user names, by chunks (keyset pagination)
+    async def abonement_visits_stream(
+        self, abonement_id: int, chunk_size: int = 500
+    ) -> AsyncIterator[Sequence[Tuple[int, datetime, Optional[str]]]]:
+        last: Optional[Tuple[datetime, int]] = None
+        while True:
+            stmt = (
+                select(TgAbonementVisit.id, TgAbonementVisit.ts, TgUser.name)
+                .join(TgUser, TgAbonementVisit.user_id == TgUser.id)
+                .where(TgAbonementVisit.abonement_id == abonement_id)
+                .order_by(TgAbonementVisit.ts, TgAbonementVisit.id)
+                .limit(chunk_size)
+            )
+            if last:
+                stmt = stmt.where(
+                    tuple_(TgAbonementVisit.ts, TgAbonementVisit.id) > tuple_(*last)
+                )
+            result = await self.session.execute(stmt)
+            chunk = result.tuples().all()
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = (chunk[-1][1], chunk[-1][0])
 
     # Abonement visits left
     async def abonement_visits_left(self, abonement: TgAbonement) -> Optional[int]:
         total_visits = abonement.total_visits
         if not total_visits:
             return None
-        stmt = (
-            func.count().select().where(TgAbonementVisit.abonement_id == abonement.id)
-        )
-        result = await self.session.execute(stmt)
-        visits_count = result.scalar() or 0
-        return total_visits - visits_count
+        return total_visits - abonement.visits_count
 
-    # Abonement visit add
+    # Abonement visit add with visits left (None for unlimited Abonement).
+    # One statement: counter is increased only if Abonement is not empty
+    # (concurrent visits wait for the row lock and recheck the limit),
+    # visit is inserted only if counter was increased.
     async def abonement_visit_add(
         self, abonement_id: int, user_id: int
-    ) -> Optional[TgAbonementVisit]:
-        abonement = await self.abonement_by_id(abonement_id)
-        if not abonement or abonement.hidden:
-            return None
-        visits_left = await self.abonement_visits_left(abonement)
-        if visits_left is not None and visits_left <= 0:
+    ) -> Optional[Tuple[TgAbonementVisit, Optional[int]]]:
+        admitted = (
+            update(TgAbonement)
+            .where(
+                TgAbonement.id == abonement_id,
+                not_(TgAbonement.hidden),
+                or_(
+                    TgAbonement.total_visits == 0,
+                    TgAbonement.visits_count < TgAbonement.total_visits,
+                ),
+            )
+            .values(
+                visits_count=TgAbonement.visits_count + 1,
+                owner_visits_count=TgAbonement.owner_visits_count
+                + case((TgAbonement.owner_id == user_id, 1), else_=0),
+            )
+            .returning(
+                TgAbonement.id,
+                (TgAbonement.total_visits - TgAbonement.visits_count).label("left"),
+                TgAbonement.total_visits,
+            )
+            .cte("admitted")
+        )
+        user_counted = (
+            update(TgAbonementUser)
+            .where(
+                TgAbonementUser.abonement_id.in_(select(admitted.c.id)),
+                TgAbonementUser.user_id == user_id,
+            )
+            .values(visits_count=TgAbonementUser.visits_count + 1)
+            .cte("user_counted")
+        )
+        visits_left = (
+            select(admitted.c.left)
+            .where(admitted.c.total_visits != 0)
+            .scalar_subquery()
+        )
+        stmt = (
+            insert(TgAbonementVisit)
+            .from_select(
+                ["abonement_id", "user_id"],
+                select(admitted.c.id, literal(user_id)),
+            )
+            .returning(TgAbonementVisit, visits_left)
+            .add_cte(admitted)
+            .add_cte(user_counted)
+        )
+        result = await self.session.execute(stmt)
+        row = result.first()
+        await self.save()
+        if not row:
             return None
-        abonement_visit = TgAbonementVisit(abonement_id=abonement_id, user_id=user_id)
-        self.session.add(abonement_visit)
-        await self.session.commit()
-        return abonement_visit
+        abonement_visit, left = row
+        return abonement_visit, left
 
     # Abonement visit get
     async def abonement_visit_get(self, visit_id: int) -> Optional[TgAbonementVisit]:
@@ -377,7 +649,7 @@ class Database:
             return False
         # Update Visit
         visit.ts = visit_date
-        await self.session.commit()
+        await self.save()
         return True
 
     # Abonement visit delete
@@ -396,14 +668,15 @@ class Database:
         # Delete Visit
         stmt = delete(TgAbonementVisit).where(TgAbonementVisit.id == visit_id)
         await self.session.execute(stmt)
-        await self.session.commit()
+        await self.abonement_visits_count_add(abonement.id, visit.user_id, -1)
+        await self.save()
         return True
 
     # Create invite
     async def invite_create(self, token: str, group: str) -> TgInvite:
         invite = TgInvite(token=token, group=group, max_uses=0, max_days=0, active=True)
         self.session.add(invite)
-        await self.session.commit()
+        await self.save()
         return invite
 
     # Invite list
@@ -450,7 +723,8 @@ class Database:
         invite_user = TgInviteUser(user_id=user_id, invite_id=invite.id)
         self.session.add(invite_user)
         # Save changes
-        await self.session.commit()
+        await self.save()
+        self.after_commit(partial(user_cache.invalidate, user.tg_id))
         return True
 
     # Get settings
@@ -474,7 +748,7 @@ class Database:
             self.session.add(setting)
         else:
             setting.value = value
-        await self.session.commit()
+        await self.save()
         return True
 
     # Delete settings
@@ -487,5 +761,5 @@ class Database:
         if not setting:
             return False
         await self.session.delete(setting)
-        await self.session.commit()
+        await self.save()
         return True
@@ -0,0 +1,125 @@
+import logging
+from functools import partial
+from typing import Awaitable, Callable, Union
+from sqlalchemy import insert, select, text
+from sqlalchemy.sql.expression import func
+from sqlalchemy.ext.asyncio import AsyncConnection
+from storage.db_schema import Base, TgSchemaVersion
+from storage.db_partitions import partition_legacy_table, partitions_create
+
+logger = logging.getLogger(__name__)
+
+LOCK_ID = 7001  # advisory lock: bot and notifier may start at the same time
+
+
+# Delete duplicate rows (same values in columns) before unique index is
+# created: the row with the highest id is kept if keep_last, else the lowest.
+# Every deleted row is logged, so it can be restored by hand.
+async def duplicates_delete(
+    conn: AsyncConnection, table: str, columns: list[str], keep_last: bool
+) -> None:
+    match = " AND ".join(f"a.{column} = b.{column}" for column in columns)
+    result = await conn.execute(
+        text(
+            f"DELETE FROM {table} a USING {table} b WHERE {match}"
+            f" AND a.id {'<' if keep_last else '>'} b.id RETURNING a.*"
+        )
+    )
+    rows = result.mappings().all()
+    for row in rows:
+        logger.warning("Deleted duplicate row from %s: %s", table, dict(row))
+    if rows:
+        logger.warning("Deleted %d duplicate rows from %s", len(rows), table)
+
+
+# Schema migrations for databases created by older versions (PostgreSQL).
+# New databases get the same structures from create_all, so every
+# statement must be idempotent. Steps are SQL statements or coroutines.
+Step = Union[str, Callable[[AsyncConnection], Awaitable[None]]]
+MIGRATIONS: list[tuple[int, list[Step]]] = [
+    (
+        1,  # Abonement visit counters
+        [
+            "ALTER TABLE tg_abonements"
+            " ADD COLUMN IF NOT EXISTS visits_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE tg_abonement_users"
+            " ADD COLUMN IF NOT EXISTS visits_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE tg_abonements a SET visits_count ="
+            " (SELECT count(*) FROM tg_abonement_visits v"
+            " WHERE v.abonement_id = a.id)",
+            "UPDATE tg_abonement_users u SET visits_count ="
+            " (SELECT count(*) FROM tg_abonement_visits v"
+            " WHERE v.abonement_id = u.abonement_id AND v.user_id = u.user_id)",
+        ],
+    ),
+    (
+        2,  # Indexes for hot queries, unique settings and Abonement users
+        [
+            partial(
+                duplicates_delete,
+                table="tg_settings",
+                columns=["user_id", "key"],
+                keep_last=True,  # last saved value is in use
+            ),
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_tg_settings_user_id_key"
+            " ON tg_settings (user_id, key)",
+            partial(
+                duplicates_delete,
+                table="tg_abonement_users",
+                columns=["abonement_id", "user_id"],
+                keep_last=False,  # first join of user
+            ),
+            "CREATE UNIQUE INDEX IF NOT EXISTS"
+            " uq_tg_abonement_users_abonement_id_user_id"
+            " ON tg_abonement_users (abonement_id, user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_tg_abonement_users_user_id"
+            " ON tg_abonement_users (user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_tg_abonement_visits_abonement_id_ts"
+            " ON tg_abonement_visits (abonement_id, ts, id)",
+            "CREATE INDEX IF NOT EXISTS ix_tg_abonement_visits_abonement_id_user_id"
+            " ON tg_abonement_visits (abonement_id, user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_tg_invite_users_invite_id"
+            " ON tg_invite_users (invite_id)",
+        ],
+    ),
+    (
+        3,  # Log tables partitioned by month, updates as JSONB
+        [
+            partial(partition_legacy_table, table="tg_all_updates"),
+            partial(partition_legacy_table, table="tg_all_messages"),
+        ],
+    ),
+    (
+        4,  # Abonement owner visit counter (owner has no Abonement user row)
+        [
+            "ALTER TABLE tg_abonements"
+            " ADD COLUMN IF NOT EXISTS owner_visits_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE tg_abonements a SET owner_visits_count ="
+            " (SELECT count(*) FROM tg_abonement_visits v"
+            " WHERE v.abonement_id = a.id AND v.user_id = a.owner_id)",
+        ],
+    ),
+]
+
+
+# Create tables and apply pending migrations (in one transaction)
+async def migrate(conn: AsyncConnection, months_ahead: int = 1) -> None:
+    if conn.dialect.name == "postgresql":
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOCK_ID})
+    await conn.run_sync(Base.metadata.create_all)
+    result = await conn.execute(select(func.max(TgSchemaVersion.version)))
+    current_version = result.scalar() or 0
+    logger.info("DB schema version: %s", current_version)
+    for version, steps in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info("Apply DB migration %s...", version)
+        for step in steps:
+            if isinstance(step, str):
+                await conn.execute(text(step))
+            else:
+                await step(conn)
+        await conn.execute(insert(TgSchemaVersion).values(version=version))
+    if conn.dialect.name == "postgresql":
+        await partitions_create(conn, months_ahead)
+    logger.info("DB schema is up to date")
@@ -0,0 +1,247 @@
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import date
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from storage.db_schema import Base
+
+logger = logging.getLogger(__name__)
+
+# Tables partitioned by month of "ts" (PostgreSQL)
+TABLES = ["tg_all_updates", "tg_all_messages"]
+
+# Columns to convert when legacy table rows are copied
+CONVERT = {"tg_all_updates": {"tg_update": "tg_update::jsonb"}}
+
+PARTITION_NAME = re.compile(r"_y(\d{4})m(\d{2})$")
+
+
+# First day of month shifted by months
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+# Partition name for month
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+# Check if table is partitioned
+async def is_partitioned(conn: AsyncConnection, table: str) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table p"
+            " JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table"
+        ),
+        {"table": table},
+    )
+    return result.first() is not None
+
+
+# Check if table exists
+async def table_exists(conn: AsyncConnection, table: str) -> bool:
+    result = await conn.execute(text("SELECT to_regclass(:table)"), {"table": table})
+    return result.scalar() is not None
+
+
+# Create partition for month. Rows of the month in DEFAULT partition make
+# CREATE ... PARTITION OF fail, so they are moved to new table first, which
+# is attached then.
+async def partition_create(conn: AsyncConnection, table: str, month: date) -> None:
+    name = partition_name(table, month)
+    if await table_exists(conn, name):
+        return
+    bounds = f"FROM ('{month}') TO ('{add_months(month, 1)}')"
+    default = f"{table}_default"
+    month_range = {"start": month, "end": add_months(month, 1)}
+    has_default_rows = False
+    if await table_exists(conn, default):
+        result = await conn.execute(
+            text(f"SELECT 1 FROM {default} WHERE ts >= :start AND ts < :end LIMIT 1"),
+            month_range,
+        )
+        has_default_rows = result.first() is not None
+    if not has_default_rows:
+        await conn.execute(
+            text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES {bounds}")
+        )
+        return
+    logger.info("Move rows of %s from %s to %s...", month, default, name)
+    await conn.execute(
+        text(
+            f"CREATE TABLE {name}"
+            f" (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+    )
+    await conn.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {default}"
+            " WHERE ts >= :start AND ts < :end RETURNING *)"
+            f" INSERT INTO {name} SELECT * FROM moved"
+        ),
+        month_range,
+    )
+    await conn.execute(
+        text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}")
+    )
+
+
+# Create DEFAULT partition (for rows out of monthly partitions)
+async def default_partition_create(conn: AsyncConnection, table: str) -> None:
+    await conn.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+    )
+
+
+# Create DEFAULT partitions and partitions from this month to months ahead
+async def partitions_create(conn: AsyncConnection, months_ahead: int = 1) -> None:
+    this_month = date.today().replace(day=1)
+    for table in TABLES:
+        await default_partition_create(conn, table)
+        for months in range(months_ahead + 1):
+            await partition_create(conn, table, add_months(this_month, months))
+    logger.info("Partitions created up to %s month(s) ahead", months_ahead)
+
+
+# Move rows out of DEFAULT partition to monthly partitions (so they are
+# archived with their months)
+async def default_partition_split(conn: AsyncConnection, table: str) -> None:
+    default = f"{table}_default"
+    if not await table_exists(conn, default):
+        return
+    result = await conn.execute(
+        text(f"SELECT DISTINCT date_trunc('month', ts)::date FROM {default}")
+    )
+    for (month,) in result.all():
+        await partition_create(conn, table, month)
+
+
+# Monthly partitions of table (name and month)
+async def partitions_list(conn: AsyncConnection, table: str) -> list[tuple[str, date]]:
+    result = await conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i"
+            " JOIN pg_class c ON c.oid = i.inhrelid"
+            " JOIN pg_class p ON p.oid = i.inhparent"
+            " WHERE p.relname = :table ORDER BY c.relname"
+        ),
+        {"table": table},
+    )
+    partitions = []
+    for (name,) in result.tuples():
+        match = PARTITION_NAME.search(name)
+        if match:
+            partitions.append((name, date(int(match[1]), int(match[2]), 1)))
+    return partitions
+
+
+# Convert legacy table (created before partitioning) to partitioned table.
+# Legacy table is only renamed here (startup migration stays short), rows
+# are moved by legacy_table_copy later. New IDs continue after legacy ones.
+async def partition_legacy_table(conn: AsyncConnection, table: str) -> None:
+    if await is_partitioned(conn, table):
+        return
+    logger.info("Convert %s to partitioned table...", table)
+    legacy = f"{table}_legacy"
+    await conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    await conn.execute(text(f"ALTER SEQUENCE {table}_id_seq RENAME TO {legacy}_id_seq"))
+    await conn.execute(
+        text(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {legacy}_pkey")
+    )
+    await conn.execute(
+        text(f"ALTER INDEX IF EXISTS {table}_id_key RENAME TO {legacy}_id_key")
+    )
+    await conn.run_sync(Base.metadata.tables[table].create)
+    await default_partition_create(conn, table)
+    await conn.execute(
+        text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'),"
+            f" (SELECT coalesce(max(id), 0) + 1 FROM {legacy}), false)"
+        )
+    )
+    logger.info("Table %s converted, rows are left in %s", table, legacy)
+
+
+# Move rows of legacy table to partitioned table by batches (one transaction
+# per batch, may be interrupted and run again), then drop legacy table
+async def legacy_table_copy(engine: AsyncEngine, table: str, batch_size: int) -> int:
+    legacy = f"{table}_legacy"
+    async with engine.begin() as conn:
+        if not await table_exists(conn, legacy):
+            return 0
+        logger.info("Copy rows from %s...", legacy)
+        # Partitions for all months with rows
+        result = await conn.execute(text(f"SELECT min(ts) FROM {legacy}"))
+        first_ts = result.scalar()
+        if first_ts:
+            month = first_ts.date().replace(day=1)
+            while month <= date.today():
+                await partition_create(conn, table, month)
+                month = add_months(month, 1)
+    columns = [column.name for column in Base.metadata.tables[table].columns]
+    values = [CONVERT.get(table, {}).get(column, column) for column in columns]
+    copied = 0
+    last_id = 0
+    while True:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    f"WITH moved AS (DELETE FROM {legacy} WHERE id IN"
+                    f" (SELECT id FROM {legacy} WHERE id > :last_id"
+                    " ORDER BY id LIMIT :limit) RETURNING *),"
+                    f" inserted AS (INSERT INTO {table} ({', '.join(columns)})"
+                    f" SELECT {', '.join(values)} FROM moved)"
+                    " SELECT count(*), max(id) FROM moved"
+                ),
+                {"last_id": last_id, "limit": batch_size},
+            )
+            count, max_id = result.one()
+        copied += count
+        if not count:
+            break
+        last_id = max_id
+        logger.info("Copied %d row(s) from %s", copied, legacy)
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE {legacy}"))
+    logger.info("Table %s copied and dropped", legacy)
+    return copied
+
+
+# Export partitions older than kept months to gzipped JSON lines and drop them
+async def partitions_archive(
+    conn: AsyncConnection, keep_months: int, archive_dir: str
+) -> list[str]:
+    first_kept = add_months(date.today().replace(day=1), -keep_months)
+    archived = []
+    for table in TABLES:
+        for name, month in await partitions_list(conn, table):
+            if month >= first_kept:
+                continue
+            path = await partition_export(conn, name, archive_dir)
+            await conn.commit()  # close export cursor
+            await conn.execute(text(f"DROP TABLE {name}"))
+            await conn.commit()
+            logger.info("Partition %s archived to %s", name, path)
+            archived.append(name)
+    return archived
+
+
+# Export partition rows to gzipped JSON lines (written to temporary file first)
+async def partition_export(conn: AsyncConnection, name: str, archive_dir: str) -> str:
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.jsonl.gz")
+    temp_path = path + ".tmp"
+    result = await conn.stream(text(f"SELECT * FROM {name} ORDER BY id"))
+    try:
+        with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+            async for row in result.mappings():
+                line = json.dumps(dict(row), ensure_ascii=False, default=str)
+                file.write(line + "\n")
+    finally:
+        await result.close()
+    os.replace(temp_path, path)
+    return path
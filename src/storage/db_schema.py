@@ -1,9 +1,10 @@
 import datetime
-from typing import List
+from typing import Any, List
 from typing import Optional
 from sqlalchemy import func
-from sqlalchemy import ForeignKey
-from sqlalchemy import String, BigInteger, TIMESTAMP
+from sqlalchemy import ForeignKey, Index, UniqueConstraint
+from sqlalchemy import String, BigInteger, TIMESTAMP, JSON
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -15,20 +16,52 @@ class Base(DeclarativeBase):
     pass
 
 
+class TgSchemaVersion(Base):
+    __tablename__ = "tg_schema_versions"
+    version: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    ts: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP, nullable=False, server_default=func.CURRENT_TIMESTAMP()
+    )
+
+
+# Log tables are partitioned by month of "ts" (see storage.db_partitions)
 class TgUpdate(Base):
     __tablename__ = "tg_all_updates"
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
+    __table_args__ = (
+        Index("ix_tg_all_updates_ts", "ts", postgresql_using="brin"),
+        Index(
+            "ix_tg_all_updates_tg_update",
+            "tg_update",
+            postgresql_using="gin",
+            postgresql_ops={"tg_update": "jsonb_path_ops"},
+        ),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     ts: Mapped[datetime.datetime] = mapped_column(
-        TIMESTAMP, nullable=False, server_default=func.CURRENT_TIMESTAMP()
+        TIMESTAMP,
+        primary_key=True,
+        nullable=False,
+        server_default=func.CURRENT_TIMESTAMP(),
+    )
+    tg_update: Mapped[dict[str, Any]] = mapped_column(
+        JSON().with_variant(JSONB, "postgresql")
     )
-    tg_update: Mapped[str]
 
 
 class TgMessage(Base):
     __tablename__ = "tg_all_messages"
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
+    __table_args__ = (
+        Index("ix_tg_all_messages_ts", "ts", postgresql_using="brin"),
+        Index("ix_tg_all_messages_tg_id_ts", "tg_id", "ts"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     ts: Mapped[datetime.datetime] = mapped_column(
-        TIMESTAMP, nullable=False, server_default=func.CURRENT_TIMESTAMP()
+        TIMESTAMP,
+        primary_key=True,
+        nullable=False,
+        server_default=func.CURRENT_TIMESTAMP(),
     )
     tg_id: Mapped[Optional[int]] = mapped_column(BigInteger)
     tg_name: Mapped[Optional[str]] = mapped_column(String(60))
@@ -123,6 +156,8 @@ class TgAbonement(Base):
     expiry_date: Mapped[Optional[datetime.datetime]]
     description: Mapped[Optional[str]]
     hidden: Mapped[bool]
+    visits_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    owner_visits_count: Mapped[int] = mapped_column(default=0, server_default="0")
     create_ts: Mapped[datetime.datetime] = mapped_column(
         TIMESTAMP,
         nullable=False,
@@ -140,15 +175,26 @@ class TgAbonement(Base):
 
 class TgAbonementUser(Base):
     __tablename__ = "tg_abonement_users"
+    __table_args__ = (
+        UniqueConstraint(
+            "abonement_id", "user_id", name="uq_tg_abonement_users_abonement_id_user_id"
+        ),
+        Index("ix_tg_abonement_users_user_id", "user_id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
     user: Mapped[TgUser] = relationship("TgUser", back_populates="abonement_uses")
     user_id: Mapped[int] = mapped_column(ForeignKey("tg_users.id"))
     abonement: Mapped[TgAbonement] = relationship("TgAbonement", back_populates="users")
     abonement_id: Mapped[int] = mapped_column(ForeignKey("tg_abonements.id"))
+    visits_count: Mapped[int] = mapped_column(default=0, server_default="0")
 
 
 class TgAbonementVisit(Base):
     __tablename__ = "tg_abonement_visits"
+    __table_args__ = (
+        Index("ix_tg_abonement_visits_abonement_id_ts", "abonement_id", "ts", "id"),
+        Index("ix_tg_abonement_visits_abonement_id_user_id", "abonement_id", "user_id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
     ts: Mapped[datetime.datetime] = mapped_column(
         TIMESTAMP,
@@ -189,6 +235,7 @@ class TgInvite(Base):
 
 class TgInviteUser(Base):
     __tablename__ = "tg_invite_users"
+    __table_args__ = (Index("ix_tg_invite_users_invite_id", "invite_id"),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
     user: Mapped[TgUser] = relationship("TgUser", back_populates="invites")
     user_id: Mapped[int] = mapped_column(ForeignKey("tg_users.id"))
@@ -203,6 +250,9 @@ class TgInviteUser(Base):
 
 class TgSettings(Base):
     __tablename__ = "tg_settings"
+    __table_args__ = (
+        UniqueConstraint("user_id", "key", name="uq_tg_settings_user_id_key"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, unique=True)
     key: Mapped[str] = mapped_column(String(60))
     value: Mapped[str] = mapped_column(String(60))
@@ -0,0 +1,50 @@
+import logging
+from copy import deepcopy
+from typing import Any, Dict, Optional
+from aiogram.fsm.context import FSMContext
+
+logger = logging.getLogger(__name__)
+
+
+# FSM context with data snapshot for one update: data is read from storage
+# once and written back once by flush() (only if changed). State is not cached.
+class FSMSnapshot(FSMContext):
+    def __init__(self, context: FSMContext) -> None:
+        super().__init__(storage=context.storage, key=context.key)
+        self.data: Optional[Dict[str, Any]] = None
+        self.dirty = False
+
+    # Read data from storage on first access
+    async def load(self) -> Dict[str, Any]:
+        if self.data is None:
+            self.data = await self.storage.get_data(key=self.key)
+        return self.data
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self.data = deepcopy(data)
+        self.dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        return deepcopy(await self.load())
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        data = await self.load()
+        return deepcopy(data.get(key, default))
+
+    async def update_data(
+        self, data: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self.load()
+        current.update(deepcopy(kwargs))
+        self.dirty = True
+        return deepcopy(current)
+
+    # Write data to storage if it was changed
+    async def flush(self) -> None:
+        if not self.dirty or self.data is None:
+            return
+        await self.storage.set_data(key=self.key, data=self.data)
+        self.dirty = False
+        logger.debug("FSM data saved for %s", self.key.user_id)
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Local manifest of generated tables: table name -> parameters hash,
+# spreadsheet modification time and hash of uploaded data
+class TableManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables: dict[str, dict[str, str]] = self.load()
+
+    # Read manifest file (empty manifest if file is missing or broken)
+    def load(self) -> dict[str, dict[str, str]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.warning("Can't read table manifest %s", self.path, exc_info=True)
+            return {}
+
+    # Get table entry
+    def get(self, name: str) -> Optional[dict[str, str]]:
+        with self.lock:
+            entry = self.tables.get(name)
+            return dict(entry) if entry else None
+
+    # Store table entry (written to temporary file first)
+    def set(self, name: str, entry: dict[str, str]) -> None:
+        with self.lock:
+            self.tables[name] = dict(entry)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.tables, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+
+
+# Hash of table parameters (changed range or fields invalidate manifest entry)
+def params_hash(table_params: dict) -> str:
+    params = [
+        table_params.get(key)
+        for key in ("spreadsheetId", "range", "fields", "output_file", "columnar")
+    ]
+    content = json.dumps(params, ensure_ascii=False)
+    return hashlib.sha256(content.encode()).hexdigest()
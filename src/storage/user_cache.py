@@ -0,0 +1,52 @@
+import logging
+import threading
+from typing import Optional
+from cachetools import TTLCache
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE = config["BOT"].get("USER_CACHE", {})
+
+
+# Cache of users by Telegram ID: tg_id -> (user_id, groups), TTL + LRU
+class UserCache:
+    def __init__(self, maxsize: int = 1000, ttl: float = 300):
+        self.cache: TTLCache[int, tuple[int, tuple[str, ...]]] = TTLCache(
+            maxsize=maxsize, ttl=ttl
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Get user ID and groups
+    def get(self, tg_id: int) -> Optional[tuple[int, list[str]]]:
+        with self.lock:
+            entry = self.cache.get(tg_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        user_id, groups = entry
+        return user_id, list(groups)
+
+    # Store user ID and groups
+    def set(self, tg_id: int, user_id: int, groups: list[str]) -> None:
+        with self.lock:
+            self.cache[tg_id] = (user_id, tuple(groups))
+
+    # Drop user (after user groups change)
+    def invalidate(self, tg_id: int) -> None:
+        with self.lock:
+            self.cache.pop(tg_id, None)
+        logger.info("User %s dropped from cache", tg_id)
+
+    # Hits, misses and size
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache)}
+
+
+user_cache = UserCache(
+    maxsize=USER_CACHE.get("SIZE", 1000), ttl=USER_CACHE.get("TTL", 300)
+)
@@ -0,0 +1,82 @@
+import logging
+from typing import Iterable, Optional
+from redis import Redis, RedisError
+
+logger = logging.getLogger(__name__)
+
+TTL = 7 * 24 * 3600  # seconds
+
+
+# Cache of Visit rows in Abonement spreadsheets (Visit ID -> row index)
+class VisitRowsCache:
+    def __init__(self, redis: Redis, ttl: int = TTL):
+        self.redis = redis
+        self.ttl = ttl
+
+    def rows_key(self, spreadsheet_id: str) -> str:
+        return f"visit_rows:{spreadsheet_id}"
+
+    def meta_key(self, spreadsheet_id: str) -> str:
+        return f"visit_rows_meta:{spreadsheet_id}"
+
+    # Get next free row if cache matches spreadsheet modification time
+    def next_row(self, spreadsheet_id: str, modified: str) -> Optional[int]:
+        try:
+            meta = self.redis.hgetall(self.meta_key(spreadsheet_id))
+        except RedisError:
+            logger.warning("Can't read Visit rows cache", exc_info=True)
+            return None
+        if not meta or meta.get(b"modified", b"").decode() != modified:
+            logger.info("Visit rows cache miss for %s", spreadsheet_id)
+            return None
+        return int(meta[b"next_row"])
+
+    # Get rows for selected Visits (None on cache error)
+    def rows(
+        self, spreadsheet_id: str, visit_ids: Iterable[str]
+    ) -> Optional[dict[str, int]]:
+        visit_ids = list(visit_ids)
+        if not visit_ids:
+            return {}
+        try:
+            values = self.redis.hmget(self.rows_key(spreadsheet_id), visit_ids)
+        except RedisError:
+            logger.warning("Can't read Visit rows cache", exc_info=True)
+            return None
+        return {
+            visit_id: int(value)
+            for visit_id, value in zip(visit_ids, values)
+            if value is not None
+        }
+
+    # Store rows (replace=True drops rows stored before)
+    def store(
+        self,
+        spreadsheet_id: str,
+        rows: dict[str, int],
+        next_row: int,
+        modified: str,
+        replace: bool = False,
+    ) -> None:
+        rows_key = self.rows_key(spreadsheet_id)
+        meta_key = self.meta_key(spreadsheet_id)
+        try:
+            pipe = self.redis.pipeline()
+            if replace:
+                pipe.delete(rows_key)
+            if rows:
+                pipe.hset(rows_key, mapping=rows)
+            pipe.hset(meta_key, mapping={"modified": modified, "next_row": next_row})
+            pipe.expire(rows_key, self.ttl)
+            pipe.expire(meta_key, self.ttl)
+            pipe.execute()
+        except RedisError:
+            logger.warning("Can't store Visit rows cache", exc_info=True)
+            self.invalidate(spreadsheet_id)
+
+    # Drop cache for spreadsheet
+    def invalidate(self, spreadsheet_id: str) -> None:
+        try:
+            self.redis.delete(self.meta_key(spreadsheet_id))
+        except RedisError:
+            logger.warning("Can't invalidate Visit rows cache", exc_info=True)
@@ -1,6 +1,10 @@
 import ftplib
 import os
 import logging
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Iterator
 from utils.config import config
 
 logger = logging.getLogger(__name__)
@@ -13,11 +17,14 @@ class Ftp:
     def start(self):
         # Read credentials from file
         logger.info("Authenticating to FTP...")
-        self.session = ftplib.FTP(
-            config["FTP"]["server"],
-            config["FTP"]["username"],
-            config["FTP"]["password"],
-        )
+        session = ftplib.FTP()
+        try:
+            session.connect(config["FTP"]["server"])
+            session.login(config["FTP"]["username"], config["FTP"]["password"])
+        except BaseException:
+            session.close()  # don't leave socket open after failed login
+            raise
+        self.session = session
         if not self.session:
             logger.error("Failed to authenticate to FTP")
             return
@@ -32,7 +39,8 @@ class Ftp:
         if not self.session:
             return
         self.session.cwd(dst_path)
-        self.session.storbinary("STOR " + dst_file, open(src_file, "rb"))
+        with open(src_file, "rb") as f:
+            self.session.storbinary("STOR " + dst_file, f)
         logger.info(f"Uploaded file: {file_name}")
 
     def quit(self) -> None:
@@ -41,3 +49,52 @@ class Ftp:
             return
         self.session.quit()
         logger.info("Disconnected from FTP")
+
+    # Close connection without QUIT (after errors)
+    def close(self) -> None:
+        if self.session:
+            self.session.close()
+            self.session = None
+
+
+# Pool of FTP connections for parallel uploads (opened on demand and reused)
+class FtpPool:
+    def __init__(self, size: int = 2):
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.idle: queue.LifoQueue[Ftp] = queue.LifoQueue()
+
+    # Take connection (waits while all connections are busy). Slot is
+    # released when connection can't be opened, so the pool doesn't shrink.
+    @contextmanager
+    def connection(self) -> Iterator[Ftp]:
+        self.slots.acquire()
+        try:
+            uploader = self.idle.get_nowait()
+        except queue.Empty:
+            uploader = Ftp()
+            try:
+                uploader.start()
+            except BaseException:
+                self.slots.release()
+                raise
+        try:
+            yield uploader
+        except BaseException:
+            uploader.close()  # connection state is unknown
+            raise
+        else:
+            self.idle.put(uploader)
+        finally:
+            self.slots.release()
+
+    # Disconnect all idle connections
+    def quit(self) -> None:
+        while True:
+            try:
+                uploader = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                uploader.quit()
+            except ftplib.all_errors:
+                logger.warning("Can't disconnect from FTP", exc_info=True)
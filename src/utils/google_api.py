@@ -1,45 +1,114 @@
 import datetime
+import hashlib
 import json
 import logging
+import os
+import threading
 import apiclient.discovery
+from dataclasses import dataclass
 from dateutil import parser
+from functools import partial
+from itertools import islice
 from google.oauth2.service_account import Credentials
-from typing import Optional, Tuple, List, Union
+from googleapiclient.discovery_cache import get_static_doc
+from redis import Redis
+from typing import Iterable, Iterator, Optional, Tuple, List, Union
 from utils.config import config
-from const.formats import date_h_m_s_fmt
+from const.formats import date_h_m_fmt, date_h_m_s_fmt
+from storage.visit_rows import VisitRowsCache
 
 logger = logging.getLogger(__name__)
 
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+EDITED_COLOR = [1.0, 1.0, 0.7]
+DELETED_COLOR = [1.0, 0.7, 0.7]
+DATE_TIME_PATTERN = "dd.mm.yyyy hh:mm"
+SERIAL_DATE_EPOCH = datetime.datetime(1899, 12, 30)
+JS_CHUNK_ROWS = 1000  # rows serialized per write
+dumpJson = partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+REDIS = config.get("REDIS", {})
+
+
+# Process-wide factory of Google API services
+class GoogleClient:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.credentials: Optional[Credentials] = None
+        self.documents: dict[Tuple[str, str], dict] = {}
+        self.local = threading.local()  # httplib2 is not thread-safe
+
+    # Get credentials (token is refreshed by google-auth on expiry only)
+    def getCredentials(self) -> Credentials:
+        with self.lock:
+            if not self.credentials:
+                logger.info("Loading Google credentials...")
+                self.credentials = Credentials.from_service_account_info(
+                    config["GOOGLE"]["CRED"], scopes=SCOPES
+                )
+            return self.credentials
+
+    # Get discovery document (bundled with google-api-python-client)
+    def getDocument(self, name: str, version: str) -> dict:
+        with self.lock:
+            if (name, version) not in self.documents:
+                doc = get_static_doc(name, version)
+                if not doc:
+                    raise ValueError(f"No discovery document for {name} {version}")
+                self.documents[(name, version)] = json.loads(doc)
+            return self.documents[(name, version)]
+
+    # Get service (one per thread, reuses HTTP connections)
+    def getService(self, name: str, version: str):
+        services = getattr(self.local, "services", None)
+        if services is None:
+            services = self.local.services = {}
+        if (name, version) not in services:
+            logger.info("Building Google service %s %s...", name, version)
+            services[(name, version)] = apiclient.discovery.build_from_document(
+                self.getDocument(name, version), credentials=self.getCredentials()
+            )
+        return services[(name, version)]
+
+
+google_client = GoogleClient()
+visit_rows_cache = VisitRowsCache(
+    Redis(
+        host=REDIS.get("HOST", "localhost"),
+        port=REDIS.get("PORT", 6379),
+        db=REDIS.get("DB", 0),
+    )
+)
+
 
 class GoogleApi:
     def __init__(self) -> None:
         self.spreadsheetId: Optional[str] = None
         self.spreadsheetRange: Optional[str] = None
         self.rawData: Optional[dict] = None
+        self.modifiedTime: Optional[str] = None
 
-    # Authenticate to Google
+    # Authenticate to Google (load credentials, services are per thread)
     def auth(self) -> None:
-        # Read credentials from file
-        logger.info("Authenticating to Google...")
-        credentials = Credentials.from_service_account_info(
-            config["GOOGLE"]["CRED"],
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
-            ],
-        )
-        # Select service modules
-        self.service_sheets = apiclient.discovery.build(
-            "sheets", "v4", credentials=credentials
-        )
-        self.service_drive = apiclient.discovery.build(
-            "drive", "v3", credentials=credentials
-        )
-        logger.info("Done authenticating to Google")
+        google_client.getCredentials()
+
+    # Sheets service of current thread (resolved on each use: instance may
+    # be used from other threads than the one that called auth)
+    @property
+    def service_sheets(self):
+        return google_client.getService("sheets", "v4")
+
+    # Drive service of current thread
+    @property
+    def service_drive(self):
+        return google_client.getService("drive", "v3")
 
     # Set spreadsheet ID
     def setSpreadsheetId(self, spreadsheetId: str) -> None:
         self.spreadsheetId = spreadsheetId
+        self.modifiedTime = None
 
     # Set spreadsheet range
     def setSpreadsheetRange(self, spreadsheetRange: str) -> None:
@@ -56,50 +125,90 @@ class GoogleApi:
         )
         logger.info(f"Done reading table {self.spreadsheetId}")
 
-    # Parse spreadsheet data
+    # Parse spreadsheet data (rows are converted while saved, see iterRows)
     def parseSpreadsheet(self, fields: list[str]) -> None:
         logger.info("Parsing data...")
-        self.combinedData = list()
-        # Iterate over rows
+        self.fields = fields
+        self.rowsCount = len(self.rawData.get("values", [])) if self.rawData else 0
+        if not self.rawData:
+            return
+        # Get date of last update (if not read before) and generation
+        if not self.modifiedTime:
+            self.readMetadata()
+        self.generationDate = datetime.datetime.now().strftime(date_h_m_s_fmt)
+        # Write details to log
+        logger.info(f"File name: {self.docName}")
+        logger.info(f"Last update: {self.lastUpdateDate}")
+        logger.info(f"Generation date: {self.generationDate}")
+        logger.info(f"Lines count: {self.rowsCount}")
+
+    # Rows as lists of values (one value per field)
+    def iterRows(self) -> Iterator[list[str]]:
         if not self.rawData:
             return
-        for rowData in self.rawData["values"]:
-            tmpRow: dict[str, str] = dict()
-            # Iterate over columns
-            col_id = 0
-            for col_name in fields:
-                tmpRow[col_name] = rowData[col_id] if col_id < len(rowData) else ""
-                col_id += 1
-            # Save row
-            self.combinedData.append(tmpRow)
-        # Get date of last update and generation
+        width = len(self.fields)
+        for rowData in self.rawData.get("values", []):
+            row = rowData[:width]
+            if len(row) < width:
+                row = row + [""] * (width - len(row))
+            yield row
+
+    # Rows as dicts (field -> value)
+    def iterRecords(self) -> Iterator[dict[str, str]]:
+        fields = self.fields
+        for row in self.iterRows():
+            yield dict(zip(fields, row))
+
+    # Rows serialized by chunks (JSON array items without brackets)
+    def iterJsonChunks(self, columnar: bool = False) -> Iterator[str]:
+        rows: Iterator = self.iterRows() if columnar else self.iterRecords()
+        while chunk := list(islice(rows, JS_CHUNK_ROWS)):
+            yield dumpJson(chunk)[1:-1]
+
+    # Read spreadsheet name and modification time
+    def readMetadata(self) -> str:
         docInfo = (
             self.service_drive.files()
             .get(fileId=self.spreadsheetId, fields="name, modifiedTime")
             .execute()
         )
         self.docName = docInfo.get("name")
-        modifiedTime = docInfo.get("modifiedTime")
-        modifiedTimeParsed = parser.parse(modifiedTime)
+        self.modifiedTime = docInfo.get("modifiedTime", "")
+        modifiedTimeParsed = parser.parse(self.modifiedTime)
         self.lastUpdateDate = modifiedTimeParsed.strftime(date_h_m_s_fmt)
-        self.generationDate = datetime.datetime.now().strftime(date_h_m_s_fmt)
-        # Write details to log
-        logger.info(f"File name: {self.docName}")
-        logger.info(f"Last update: {self.lastUpdateDate}")
-        logger.info(f"Generation date: {self.generationDate}")
-        logger.info(f"Lines count: {len(self.combinedData)}")
+        return self.modifiedTime
 
-    # Save spreadsheet data to JS file
-    def saveSpreadsheetToJs(self, filename: str) -> None:
+    # Hash of parsed data (edits that don't change data give the same hash)
+    def dataHash(self) -> str:
+        digest = hashlib.sha256()
+        for chunk in self.iterJsonChunks(columnar=True):
+            digest.update(chunk.encode())
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    # Save spreadsheet data to JS file: rows are serialized and written
+    # by chunks to temporary file, which replaces target file when done.
+    # Columnar: field names in php_columns, rows as arrays in php_data.
+    def saveSpreadsheetToJs(self, filename: str, columnar: bool = False) -> None:
         logger.info("Saving to file...")
-        with open(filename, "w") as f:
-            f.write("var php_data = ")
-            f.write(
-                json.dumps(self.combinedData, separators=(",", ":"), ensure_ascii=False)
-            )
-            f.write(";\n")
-            f.write(f'var modified_date="{self.lastUpdateDate}";\n')
-            f.write(f'var generated_date="{self.generationDate}";\n')
+        temp_filename = filename + ".tmp"
+        try:
+            with open(temp_filename, "w", encoding="utf-8") as f:
+                if columnar:
+                    f.write(f"var php_columns = {dumpJson(self.fields)};\n")
+                f.write("var php_data = [")
+                separator = ""
+                for chunk in self.iterJsonChunks(columnar):
+                    f.write(separator + chunk)
+                    separator = ","
+                f.write("];\n")
+                f.write(f'var modified_date="{self.lastUpdateDate}";\n')
+                f.write(f'var generated_date="{self.generationDate}";\n')
+            os.replace(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
         logger.info(f"Saved to file: {filename}")
 
     # Prepare folder for VirtualCamp sheets
@@ -263,138 +372,59 @@ class GoogleApi:
     # Add Visit to Abonement
     def visitAdd(self, visit_id: int, date: str, user_name: str) -> None:
         logger.info("Add Visit to Abonement...")
-        # Update fields
-        self.service_sheets.spreadsheets().values().append(
-            spreadsheetId=self.spreadsheetId,
-            insertDataOption="OVERWRITE",
-            valueInputOption="USER_ENTERED",
-            range=config["GOOGLE"]["DRIVE"]["ABONEMENT_VISIT_START"],
-            body={"values": [[date, user_name, visit_id, "1"]]},
-        ).execute()
-        logger.info("Done updating table")
+        self.visitsApply(
+            [VisitChange(visit_id, ts=date, user_name=user_name, new=True)]
+        )
 
     # Visit Update
     def visitUpdate(self, visit_id: int, visit_new_ts: str) -> None:
         logger.info("Update Visit in Abonement...")
-
-        # Find current Visit
-        res = self.findVisitById(visit_id)
-        if not res:
-            logger.info("Visit not found")
-            return
-        row_id, row = res
-
-        # Update edited Visit
-        row[0] = visit_new_ts
-        self.updateRowValues(
-            config["GOOGLE"]["DRIVE"]["ABONEMENT_VISIT_ROW"].format(
-                row_id + 1, row_id + 1
-            ),
-            [row],
-        )
-
-        # Update row color
-        self.updateRowColor([row_id, row_id + 1], [0, 4], [1.0, 1.0, 0.7])
-        logger.info("Done update Visit in Abonement")
+        self.visitsApply([VisitChange(visit_id, ts=visit_new_ts, color=EDITED_COLOR)])
 
     # Visit Delete
     def visitDelete(self, visit_id: int) -> None:
-        logger.info("Update Visit in Abonement...")
+        logger.info("Delete Visit in Abonement...")
+        self.visitsApply([VisitChange(visit_id, deleted=True, color=DELETED_COLOR)])
 
-        # Find current Visit
-        res = self.findVisitById(visit_id)
-        if not res:
-            logger.info("Visit not found")
-            return
-        row_id, row = res
-
-        # Update deleted Visit
-        row[3] = "0"
-        self.updateRowValues(
-            config["GOOGLE"]["DRIVE"]["ABONEMENT_VISIT_ROW"].format(
-                row_id + 1, row_id + 1
-            ),
-            [row],
+    # Get spreadsheet modification time and version (increased by each change)
+    def getModifiedVersion(self) -> Tuple[str, int]:
+        docInfo = (
+            self.service_drive.files()
+            .get(fileId=self.spreadsheetId, fields="modifiedTime,version")
+            .execute()
         )
+        return docInfo.get("modifiedTime", ""), int(docInfo.get("version", 0))
 
-        # Update row color
-        self.updateRowColor([row_id, row_id + 1], [0, 4], [1.0, 0.7, 0.7])
-        logger.info("Done update Visit in Abonement")
-
-    # Find Visit Row by ID
-    def findVisitById(self, visit_id: int) -> Optional[Tuple[int, List[str]]]:
-        results = (
+    # Get number of rows in Visits sheet grid
+    def getRowCount(self) -> int:
+        result = (
             self.service_sheets.spreadsheets()
-            .values()
             .get(
                 spreadsheetId=self.spreadsheetId,
-                range=config["GOOGLE"]["DRIVE"]["ABONEMENT_VISIT_RANGE"],
+                fields="sheets(properties(sheetId,gridProperties(rowCount)))",
             )
             .execute()
         )
-        current_visits = results.get("values", [])
-        found_row = None
-        for row in current_visits:
-            if row[2] == str(visit_id):
-                found_row_id = current_visits.index(row)
-                found_row = current_visits[found_row_id]
-                logger.info("Found row %s", found_row_id)
-                break
-        if not found_row:
-            logger.info("Row not found")
-            return None
-        else:
-            found_row_id += 1  # Skip header
-        return found_row_id, found_row
+        for sheet in result.get("sheets", []):
+            properties = sheet.get("properties", {})
+            if properties.get("sheetId", 0) == 0:
+                return properties.get("gridProperties", {}).get("rowCount", 0)
+        return 0
 
-    # Update Row Values
-    def updateRowValues(self, range: str, values: List[List[str]]) -> None:
-        self.service_sheets.spreadsheets().values().batchUpdate(
-            spreadsheetId=self.spreadsheetId,
-            body={
-                "valueInputOption": "USER_ENTERED",
-                "data": [{"range": range, "majorDimension": "ROWS", "values": values}],
-            },
-        ).execute()
+    # Find Visit rows (from cache if spreadsheet was not edited by others)
+    def loadVisitRows(
+        self, visit_ids: List[str], modified: str
+    ) -> Tuple[dict[str, int], int, bool]:
+        next_row = visit_rows_cache.next_row(self.spreadsheetId, modified)
+        if next_row is not None:
+            rows = visit_rows_cache.rows(self.spreadsheetId, visit_ids)
+            if rows is not None:
+                return rows, next_row, False
+        rows, next_row = self.findVisitRows()
+        return rows, next_row, True
 
-    # Update Row Color
-    def updateRowColor(
-        self, row: List[int], col: List[int], color: List[float]
-    ) -> None:
-        self.service_sheets.spreadsheets().batchUpdate(
-            spreadsheetId=self.spreadsheetId,
-            body={
-                "requests": [
-                    {
-                        "repeatCell": {
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": {
-                                        "red": color[0],
-                                        "green": color[1],
-                                        "blue": color[2],
-                                        "alpha": 1,
-                                    }
-                                }
-                            },
-                            "range": {
-                                "sheetId": 0,
-                                "startRowIndex": row[0],
-                                "endRowIndex": row[1],
-                                "startColumnIndex": col[0],
-                                "endColumnIndex": col[1],
-                            },
-                            "fields": "userEnteredFormat.backgroundColor",
-                        }
-                    }
-                ]
-            },
-        ).execute()
-
-    # Update Visits for Abonement
-    def visitsUpdateAll(self, visits: List[Tuple[int, str, str]]) -> None:
-        logger.info("Sync Visits for Abonement...")
-        # Get current Visits
+    # Find Visit rows (Visit ID -> row index, header skipped)
+    def findVisitRows(self) -> Tuple[dict[str, int], int]:
         results = (
             self.service_sheets.spreadsheets()
             .values()
@@ -405,25 +435,216 @@ class GoogleApi:
             .execute()
         )
         current_visits = results.get("values", [])
-        found_visits = []
-        for row in current_visits:
-            found_visits.append(row[2])
-
-        # Take unique Vsits
-        new_visits = []
-        for visit in visits:
-            visit_id, visit_ts, visit_user = visit
-            if str(visit_id) in found_visits:
+        rows = {}
+        for row_id, row in enumerate(current_visits, start=1):
+            if len(row) > 2:
+                rows[row[2]] = row_id
+        return rows, len(current_visits) + 1
+
+    # Apply Visit changes with one batchUpdate (values and colors)
+    def visitsApply(
+        self,
+        changes: List["VisitChange"],
+        preloaded: Optional[Tuple[dict[str, int], int]] = None,
+    ) -> int:
+        logger.info("Apply %d Visit change(s)...", len(changes))
+        modified, version = self.getModifiedVersion()
+        if preloaded:
+            rows, next_row = preloaded
+            full = True
+        else:
+            visit_ids = [str(change.visit_id) for change in changes]
+            rows, next_row, full = self.loadVisitRows(visit_ids, modified)
+        first_new_row = next_row
+        new_rows = {}
+        requests = []
+        for change in changes:
+            row_id = rows.get(str(change.visit_id))
+            if row_id is None and not change.new:
+                logger.info("Visit %s not found", change.visit_id)
                 continue
-            new_visits.append([visit_ts, visit_user, visit_id, "1"])
+            if row_id is None:
+                # Add new Visit
+                row_id = next_row
+                next_row += 1
+                new_rows[str(change.visit_id)] = row_id
+                requests.append(
+                    updateCellsRequest(
+                        row_id,
+                        0,
+                        [
+                            dateCell(change.ts),
+                            {"userEnteredValue": {"stringValue": change.user_name}},
+                            {"userEnteredValue": {"numberValue": change.visit_id}},
+                            {
+                                "userEnteredValue": {
+                                    "numberValue": 0 if change.deleted else 1
+                                }
+                            },
+                        ],
+                        "userEnteredValue",
+                    )
+                )
+            else:
+                # Update existing Visit
+                if change.ts:
+                    requests.append(
+                        updateCellsRequest(
+                            row_id,
+                            0,
+                            [dateCell(change.ts)],
+                            "userEnteredValue,userEnteredFormat.numberFormat",
+                        )
+                    )
+                if change.deleted:
+                    requests.append(
+                        updateCellsRequest(
+                            row_id,
+                            3,
+                            [{"userEnteredValue": {"numberValue": 0}}],
+                            "userEnteredValue",
+                        )
+                    )
+            if change.color:
+                requests.append(rowColorRequest(row_id, change.color))
+        # Grow grid for new rows (updateCells doesn't add rows) and set date format
+        if next_row > first_new_row:
+            row_count = self.getRowCount()
+            if next_row > row_count:
+                requests.insert(0, appendRowsRequest(next_row - row_count))
+            requests.append(
+                {
+                    "repeatCell": {
+                        "cell": dateCell(None),
+                        "range": gridRange(first_new_row, next_row, 0, 1),
+                        "fields": "userEnteredFormat.numberFormat",
+                    }
+                }
+            )
+        if requests:
+            self.service_sheets.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheetId, body={"requests": requests}
+            ).execute()
+            logger.info("Done applying %d request(s)", len(requests))
+            # Cache is valid for modification time after write only if
+            # nobody changed spreadsheet since it was read (one change: ours)
+            modified, written_version = self.getModifiedVersion()
+            if written_version > version + 1:
+                logger.info("Spreadsheet changed by others, drop Visit rows cache")
+                visit_rows_cache.invalidate(self.spreadsheetId)
+                return next_row
+        else:
+            logger.info("Nothing to update")
+        # Update Visit rows cache
+        if full:
+            rows.update(new_rows)
+            new_rows = rows
+        visit_rows_cache.store(
+            self.spreadsheetId, new_rows, next_row, modified, replace=full
+        )
+        return next_row
 
-        # Add new Visits
+    # Update Visits for Abonement (add missing Visits, may be called by chunks)
+    def visitsUpdateAll(
+        self,
+        visits: Iterable[Tuple[int, str, str]],
+        preloaded: Optional[Tuple[dict[str, int], int]] = None,
+    ) -> Tuple[dict[str, int], int]:
+        logger.info("Sync Visits for Abonement...")
+        rows, next_row = preloaded if preloaded else self.findVisitRows()
+        new_visits = [
+            VisitChange(visit_id, ts=visit_ts, user_name=visit_user, new=True)
+            for visit_id, visit_ts, visit_user in visits
+            if str(visit_id) not in rows
+        ]
         logger.info("Found %d new Visits...", len(new_visits))
-        self.service_sheets.spreadsheets().values().append(
-            spreadsheetId=self.spreadsheetId,
-            insertDataOption="OVERWRITE",
-            valueInputOption="USER_ENTERED",
-            range=config["GOOGLE"]["DRIVE"]["ABONEMENT_VISIT_START"],
-            body={"values": new_visits},
-        ).execute()
+        if new_visits:
+            next_row = self.visitsApply(new_visits, preloaded=(rows, next_row))
         logger.info("Done Sync Visits")
+        return rows, next_row
+
+
+# Visit change for Abonement spreadsheet (merged by write-behind sync)
+@dataclass
+class VisitChange:
+    visit_id: int
+    ts: Optional[str] = None
+    user_name: str = ""
+    new: bool = False
+    deleted: bool = False
+    color: Optional[List[float]] = None
+
+    # Merge next change of the same Visit
+    def merge(self, other: "VisitChange") -> None:
+        self.ts = other.ts or self.ts
+        self.user_name = other.user_name or self.user_name
+        self.new = self.new or other.new
+        self.deleted = self.deleted or other.deleted
+        self.color = other.color or self.color
+
+
+# Convert date to spreadsheet serial number
+def toSerialDate(ts: str) -> float:
+    delta = datetime.datetime.strptime(ts, date_h_m_fmt) - SERIAL_DATE_EPOCH
+    return delta.days + delta.seconds / 86400
+
+
+# Cell with date value and format
+def dateCell(ts: Optional[str]) -> dict:
+    cell: dict = {
+        "userEnteredFormat": {
+            "numberFormat": {"type": "DATE_TIME", "pattern": DATE_TIME_PATTERN}
+        }
+    }
+    if ts:
+        cell["userEnteredValue"] = {"numberValue": toSerialDate(ts)}
+    return cell
+
+
+# Range on Visits sheet
+def gridRange(row_start: int, row_end: int, col_start: int, col_end: int) -> dict:
+    return {
+        "sheetId": 0,
+        "startRowIndex": row_start,
+        "endRowIndex": row_end,
+        "startColumnIndex": col_start,
+        "endColumnIndex": col_end,
+    }
+
+
+# Request: update cells in one row
+def updateCellsRequest(
+    row_id: int, col_id: int, cells: List[dict], fields: str
+) -> dict:
+    return {
+        "updateCells": {
+            "rows": [{"values": cells}],
+            "start": {"sheetId": 0, "rowIndex": row_id, "columnIndex": col_id},
+            "fields": fields,
+        }
+    }
+
+
+# Request: add rows to the end of grid
+def appendRowsRequest(length: int) -> dict:
+    return {"appendDimension": {"sheetId": 0, "dimension": "ROWS", "length": length}}
+
+
+# Request: set row color
+def rowColorRequest(row_id: int, color: List[float]) -> dict:
+    return {
+        "repeatCell": {
+            "cell": {
+                "userEnteredFormat": {
+                    "backgroundColor": {
+                        "red": color[0],
+                        "green": color[1],
+                        "blue": color[2],
+                        "alpha": 1,
+                    }
+                }
+            },
+            "range": gridRange(row_id, row_id + 1, 0, 4),
+            "fields": "userEnteredFormat.backgroundColor",
+        }
+    }
@@ -1,6 +1,7 @@
 import os
 import logging
 import logging.handlers
+from multiprocessing.queues import Queue
 
 FILE = os.path.join("log", "default.log")
 LEVEL = "INFO"
@@ -23,8 +24,34 @@ def setup_logger(name: str = __name__, file: str = FILE, level: str = LEVEL):
         ],
         encoding="utf-8",
     )
+    set_library_levels()
+    logger = logging.getLogger(name)
+    return logger
+
+
+# Setup logging of child process: records are sent to queue and written
+# by handlers of parent process (see start_queue_listener)
+def setup_queue_logger(queue: Queue, level: str = LEVEL) -> None:
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+    set_library_levels()
+
+
+# Write records of child processes from queue by handlers of this process
+def start_queue_listener(queue: Queue) -> logging.handlers.QueueListener:
+    listener = logging.handlers.QueueListener(
+        queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+
+# Less verbose logging of libraries
+def set_library_levels() -> None:
     logging.getLogger("googleapiclient").setLevel(logging.WARNING)
     logging.getLogger("oauth2client").setLevel(logging.WARNING)
     logging.getLogger("pika").setLevel(logging.WARNING)
-    logger = logging.getLogger(name)
-    return logger
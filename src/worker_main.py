@@ -1,9 +1,20 @@
 import sentry_sdk
+import argparse
 import json
+import multiprocessing
 import os
 import pika
+from concurrent.futures import Executor, Future
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from logging.handlers import QueueListener
+from multiprocessing.queues import Queue
+from typing import Callable, Optional
+from pika.adapters.blocking_connection import BlockingChannel
 from utils.config import config
-from utils.log import setup_logger
+from utils.log import setup_logger, setup_queue_logger, start_queue_listener
+from modules.queue_publisher import job_queue, queue_arguments
 from modules.table_creator import TableCreator
 from modules.picture_creator import PictureCreator
 
@@ -23,9 +34,68 @@ table_creator = TableCreator()
 # Setup Picture Generator
 picture_creator = PictureCreator()
 
+# Job types: handler, executor ("process" for CPU-bound jobs, "thread" for I/O)
+# and default concurrency (overridden by WORKER.CONCURRENCY)
+JOB_TYPES: dict[str, tuple[Callable[[dict], None], str, int]] = {
+    "table_generator": (table_creator.handle_new_task, "thread", 1),
+    "pictures_generator": (picture_creator.handle_new_task, "process", 2),
+}
+CONCURRENCY = config.get("WORKER", {}).get("CONCURRENCY", {})
 
-# Handle new task from RabbitMQ
-def on_new_task_message(ch, method, properties, body):
+# Executors by job type (created on first job)
+executors: dict[str, Executor] = {}
+
+# Spawned job processes send log records to this process (one log file writer)
+job_log_queue: Optional[Queue] = None
+job_log_listener: Optional[QueueListener] = None
+
+
+# Concurrency limit for job type
+def job_concurrency(job_type: str) -> int:
+    return max(1, CONCURRENCY.get(job_type, JOB_TYPES[job_type][2]))
+
+
+# Setup job process: Sentry and logging (records go to worker process)
+def init_job_process(log_queue: Queue) -> None:
+    sentry_sdk.init(config["SENTRY"]["DSN"])
+    setup_queue_logger(log_queue, level=config["LOG"]["WORKER"]["LEVEL"])
+
+
+# Queue of log records from job processes (listener started on first use)
+def get_job_log_queue() -> Queue:
+    global job_log_queue, job_log_listener
+    if job_log_queue is None:
+        job_log_queue = multiprocessing.get_context("spawn").Queue()
+        job_log_listener = start_queue_listener(job_log_queue)
+    return job_log_queue
+
+
+# Get executor for job type
+def get_executor(job_type: str) -> Executor:
+    executor = executors.get(job_type)
+    if executor:
+        return executor
+    workers = job_concurrency(job_type)
+    if JOB_TYPES[job_type][1] == "process":
+        # Spawned processes don't inherit RabbitMQ connections of this process
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_job_process,
+            initargs=(get_job_log_queue(),),
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=job_type)
+    logger.info(
+        "Started %s executor for %s (%d)", JOB_TYPES[job_type][1], job_type, workers
+    )
+    executors[job_type] = executor
+    return executor
+
+
+# Handle new task from RabbitMQ: job runs in executor, consumer keeps
+# serving heartbeats and other messages (up to prefetch count)
+def on_new_task_message(ch: BlockingChannel, method, properties, body):
     logger.info("Got new task...")
     try:
         # Decode incoming message
@@ -36,33 +106,91 @@ def on_new_task_message(ch, method, properties, body):
         ch.basic_ack(delivery_tag=method.delivery_tag)
         return
     # Call handler by job type
-    logger.info("Prepare handler for %s", job_type)
-    if job_type == "table_generator":
-        table_creator.handle_new_task(msg)
-    elif job_type == "pictures_generator":
-        picture_creator.handle_new_task(msg)
-    else:
+    if job_type not in JOB_TYPES:
         logger.error("Unknown job type: %s", job_type)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    logger.info("Done handler for %s", job_type)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    logger.info("Prepare handler for %s", job_type)
+    future = get_executor(job_type).submit(JOB_TYPES[job_type][0], msg)
+    future.add_done_callback(partial(on_job_done, ch, method.delivery_tag, job_type))
+
+
+# Job done (in executor thread): ack message in connection thread
+def on_job_done(
+    ch: BlockingChannel, delivery_tag: int, job_type: str, future: Future
+) -> None:
+    try:
+        future.result()
+        logger.info("Done handler for %s", job_type)
+    except BrokenProcessPool:
+        logger.error("Executor for %s is broken, restarting", job_type, exc_info=True)
+        executors.pop(job_type, None)
+    except Exception:
+        logger.error("Handler for %s failed", job_type, exc_info=True)
+    ch.connection.add_callback_threadsafe(
+        partial(ch.basic_ack, delivery_tag=delivery_tag)
+    )
+
+
+# Wait for running jobs and send their acks
+def shutdown_executors(connection: pika.BlockingConnection) -> None:
+    for executor in list(executors.values()):
+        executor.shutdown(wait=True)
+    executors.clear()
+    if job_log_listener:
+        job_log_listener.stop()  # writes records left in queue
+    if connection.is_open:
+        connection.process_data_events(time_limit=0)
+
+
+# Parse command line: job types served by worker
+def parse_job_types() -> list[str]:
+    parser = argparse.ArgumentParser(description="VirtualCamp worker")
+    parser.add_argument(
+        "--jobs",
+        default=",".join(JOB_TYPES),
+        help="comma-separated job types to serve (default: all)",
+    )
+    job_types = [
+        job_type for job_type in parser.parse_args().jobs.split(",") if job_type
+    ]
+    unknown = set(job_types) - set(JOB_TYPES)
+    if unknown or not job_types:
+        parser.error(f"unknown job types: {', '.join(sorted(unknown))}")
+    return job_types
+
+
+# Queues to consume with prefetch count (concurrency of their job types)
+def job_queues(job_types: list[str]) -> dict[str, int]:
+    queues: dict[str, int] = {}
+    for job_type in job_types:
+        queue_name = job_queue(job_type)
+        queues[queue_name] = queues.get(queue_name, 0) + job_concurrency(job_type)
+    # Queue of all tasks (used before job queues) is served by full workers
+    if set(job_types) == set(JOB_TYPES):
+        queues.setdefault(
+            config["RABBITMQ"]["QUEUES"]["TASKS"], sum(map(job_concurrency, JOB_TYPES))
+        )
+    return queues
 
 
 # MAIN
 def main():
+    job_types = parse_job_types()
     logger.info(f"Starting VirtualCamp worker with PID={os.getpid()}...")
     connection = pika.BlockingConnection(pika.ConnectionParameters("localhost"))
     channel = connection.channel()
-    channel.queue_declare(queue=config["RABBITMQ"]["QUEUES"]["TASKS"])
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(
-        queue=config["RABBITMQ"]["QUEUES"]["TASKS"],
-        on_message_callback=on_new_task_message,
-    )
-    logger.info("Worker started, waiting for messages...")
+    for queue_name, prefetch_count in job_queues(job_types).items():
+        channel.queue_declare(queue=queue_name, arguments=queue_arguments(queue_name))
+        channel.basic_qos(prefetch_count=prefetch_count)  # per consumer
+        channel.basic_consume(queue=queue_name, on_message_callback=on_new_task_message)
+        logger.info("Consuming %s (prefetch %d)", queue_name, prefetch_count)
+    logger.info("Worker started for %s, waiting for messages...", ", ".join(job_types))
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         channel.stop_consuming()
+    shutdown_executors(connection)
     connection.close()
     logger.info("Finished VirtualCamp worker!")
 